@@ -1,6 +1,6 @@
 # -*- coding:utf-8 -*-
 
-import json, logging, inspect, functools
+import json, logging, inspect, functools, base64
 
 class APIError(Exception):
 	def __init__(self, error, data='', message=''):
@@ -21,7 +21,7 @@ class APIResourceNotFoundError(APIError):
 
 class APIPermissionError(APIError):
 	"""定义权限无法访问而引发的错误API类"""
-	def __init__(self, field, message=''):
+	def __init__(self, field='', message=''):
 		super().__init__('permission:forbidden', 'permission', message)
 
 class Page(object):
@@ -44,4 +44,45 @@ class Page(object):
 		return 'item_count: %s, page_count: %s, page_index: %s, page_size: %s, offset: %s, limit: %s' % (self.item_count, self.page_count, self.page_index, self.page_size, self.offset, self.limit)
 	
 	__repr__ = __str__
-		
\ No newline at end of file
+		
+#游标(keyset)分页的token：把(created_at, id)编码成不透明的字符串
+def encode_cursor(value, pk):
+	return base64.urlsafe_b64encode(('%r:%s' % (value, pk)).encode('utf-8')).decode('ascii')
+
+def decode_cursor(token):
+	if not token:
+		return None
+	try:
+		value, pk = base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8').split(':', 1)
+		return (float(value), pk)
+	except (ValueError, UnicodeError):
+		raise APIValueError('after', 'Invalid cursor.')
+
+class CursorPage(object):
+	"""配合Model.findAll(after=...)使用的分页：多取一条用来判断是否还有下一页"""
+	def __init__(self, after=None, page_size=10):
+		self.after = after or None
+		self.page_size = page_size
+		self.cursor = decode_cursor(after)
+		self.limit = page_size + 1
+		self.has_next = False
+		self.next = None
+
+	#截掉多取的一条，并生成下一页的token
+	def fill(self, items):
+		items = list(items)
+		if len(items) > self.page_size:
+			items = items[:self.page_size]
+			self.has_next = True
+			last = items[-1]
+			self.next = encode_cursor(last['created_at'], last['id'])
+		return items
+
+	#json序列化(app.json_default)只输出给客户端的字段，cursor、limit是查询用的内部值
+	def _asdict(self):
+		return dict(after=self.after, page_size=self.page_size, has_next=self.has_next, next=self.next)
+
+	def __str__(self):
+		return 'after: %s, page_size: %s, has_next: %s, next: %s' % (self.after, self.page_size, self.has_next, self.next)
+
+	__repr__ = __str__
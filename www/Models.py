@@ -2,25 +2,33 @@
 
 import time, uuid
 
-from ormstructure import Model, StringField, BooleanField, FloatField, TextField
+from ormstructure import Model, StringField, BooleanField, IntField, FloatField, TextField
 
 def next_id():
 	return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
 
 class User(Model):
 	__table__ = 'users'
+	#findNumber计数缓存的最大陈旧时间(秒)
+	__count_ttl__ = 30
+	#cookie2user在并发请求下会密集地按主键查user，合并成批量查询
+	__batch_find__ = True
 
 	id = StringField(primary_key=True, default=next_id, c_type='varchar(50)')
-	email = StringField(c_type='varchar(50)')
+	#登录、注册时按email查找
+	email = StringField(c_type='varchar(50)', unique=True)
 	passwd = StringField(c_type='varchar(50)')
 	name = StringField(c_type='varchar(50)')
 	admin = BooleanField()
 	image = StringField(c_type='varchar(500)')
-	created_at = FloatField(default=time.time)
+	created_at = FloatField(default=time.time, index=True)
 
 
 class Blog(Model):
 	__table__ = 'blogs'
+	__count_ttl__ = 30
+	#查询结果缓存时间(秒)，博客很少修改
+	__cache_ttl__ = 60
 
 	id = StringField(primary_key=True, default=next_id, c_type='varchar(50)')
 	user_id = StringField(c_type='varchar(50)')
@@ -28,11 +36,22 @@ class Blog(Model):
 	user_image = StringField(c_type='varchar(500)')
 	name = StringField(c_type='varchar(50)')
 	summary = StringField(c_type='varchar(200)')
-	content = TextField()
-	created_at = FloatField(default=time.time)
+	#正文较大，列表查询默认不加载
+	content = TextField(lazy=True)
+	#保存时预先渲染好的markdown html，以及渲染时content的sha1，用于判断是否过期
+	html_content = TextField(lazy=True)
+	content_hash = StringField(c_type='varchar(40)')
+	#评论数和最后评论时间，创建/删除评论时维护，列表页不必逐篇count；repair.py可批量重算
+	comment_count = IntField()
+	last_commented_at = FloatField(default=None)
+	created_at = FloatField(default=time.time, index=True)
 
 class Comment(Model):
 	__table__ = 'comments'
+	__count_ttl__ = 30
+	__cache_ttl__ = 60
+	#博客页按 blog_id=? order by created_at desc 查询评论
+	__indexes__ = [('blog_id', 'created_at')]
 
 	id = StringField(primary_key=True, default=next_id, c_type='varchar(50)')
 	blog_id = StringField(c_type='varchar(50)')
@@ -40,5 +59,5 @@ class Comment(Model):
 	user_name = StringField(c_type='varchar(50)')
 	user_image = StringField(c_type='varchar(500)')
 	content = TextField()
-	created_at = FloatField(default=time.time)
+	created_at = FloatField(default=time.time, index=True)
 
@@ -1,6 +1,6 @@
 # -*- coding:utf-8 -*-
-import Models, config, webstructure, ormstructure, handlers
-import asyncio, os, json, time, logging
+import Models, config, webstructure, ormstructure, handlers, schema, pagecache, compress, assets
+import asyncio, os, sys, json, time, logging
 
 from ApiError import APIPermissionError
 from datetime import datetime
@@ -20,6 +20,30 @@ async def logger(request, handler):
 	#继续处理请求
 	return await handler(request)
 
+#读写分离时的read-your-writes：cookie保存该客户端最近一次写入数据库的时间，
+#窗口期内该客户端的读都走主库(见ormstructure._read_pool)；aiohttp每个请求是独立的task，只靠请求内的contextvar对下一个请求无效
+_RYW_COOKIE = 'awelastwrite'
+
+@middleware
+async def read_your_writes(request, handler):
+	try:
+		last = float(request.cookies.get(_RYW_COOKIE, 0))
+	except ValueError:
+		last = 0
+	#不接受将来的时间，避免客户端让自己一直读主库
+	last = min(last, time.time())
+	ormstructure.set_last_write(last)
+	resp = await handler(request)
+	written = ormstructure.last_write()
+	if written > last and isinstance(resp, web.StreamResponse) and not resp.prepared:
+		resp.set_cookie(_RYW_COOKIE, '%.3f' % written, max_age=max(int(ormstructure.read_your_writes_window()), 1), httponly=True)
+	return resp
+
+#数据库取连接或执行语句超时，返回503让客户端稍后重试
+def service_unavailable(e):
+	logging.warning('database timeout: %s' % e)
+	return web.HTTPServiceUnavailable(text='Service temporarily unavailable.', headers={'Retry-After': '5'})
+
 #继续处理经过logger后的请求
 @middleware
 async def auth(request, handler):
@@ -35,7 +59,11 @@ async def auth(request, handler):
 	#logging.info('cookie_str: %s' % cookie_str)
 	#如果保存有该cookie，则验证该cookie，并返回cookie的user（即请求的账户id）
 	if cookie_str:
-		user = await cookie2user(cookie_str)
+		#auth在response_factory之外，cookie2user的数据库超时要在这里返回503
+		try:
+			user = await cookie2user(cookie_str)
+		except ormstructure.DBTimeoutError as e:
+			return service_unavailable(e)
 		if user:
 			logging.info('set current user: %s' % user.email)
 			request.__user__ = user
@@ -60,11 +88,61 @@ async def parse_data(request, handler):
 	return await handler(request)
 '''
 
+#json序列化无法直接处理的对象：紧凑行(ormstructure.CompactRow)用_asdict()，其它对象用__dict__
+def json_default(obj):
+	if hasattr(obj, '_asdict'):
+		return obj._asdict()
+	return obj.__dict__
+
+#模板渲染结果超过stream_threshold(字符)时改为分块发送，0表示只在handler返回'__stream__':True时分块发送
+_STREAM_THRESHOLD = config.configs['templates'].get('stream_threshold', 65536)
+#分块发送时每次写出的大小
+_STREAM_CHUNK = 8192
+
+'''用template.generate()逐块渲染：
+   结果不超过阈值时合并成普通的Response(可被整页缓存、压缩)；
+   handler要求('__stream__':True)或超过阈值时，立即发出响应头和已渲染的部分，其余部分边渲染边以chunked编码发送，
+   大页面(如评论很多的blog.html)首字节更早，也不需要同时在内存中保存整个html字符串和它的编码结果
+   整页缓存(pagecache)要缓存的请求不分块发送'''
+async def render_template(request, template, r):
+	if getattr(request, '__page_cache__', False):
+		stream, threshold = False, 0
+	else:
+		stream, threshold = r.get('__stream__', False), _STREAM_THRESHOLD
+	resp = None
+	L = []
+	size = 0
+	for chunk in template.generate(**r):
+		L.append(chunk)
+		size += len(chunk)
+		if resp is None and (stream or (threshold and size >= threshold)):
+			resp = web.StreamResponse()
+			resp.content_type = 'text/html'
+			resp.charset = 'utf-8'
+			#分块发送的响应不经过compress_response，由aiohttp按Accept-Encoding边发送边压缩
+			resp.enable_compression()
+			await resp.prepare(request)
+		if resp is not None and size >= _STREAM_CHUNK:
+			await resp.write(''.join(L).encode('utf-8'))
+			L = []
+			size = 0
+	if resp is None:
+		resp = web.Response(body=''.join(L).encode('utf-8'))
+		resp.content_type = 'text/html;charset=utf-8'
+		return resp
+	if L:
+		await resp.write(''.join(L).encode('utf-8'))
+	await resp.write_eof()
+	return resp
+
 #最终处理请求，返回响应给客户端
 async def response_factory(app,handler):
 	async def response(request):
 		logging.info('Response handler....')
-		r = await handler(request)
+		try:
+			r = await handler(request)
+		except ormstructure.DBTimeoutError as e:
+			return service_unavailable(e)
 		#如果经过句柄函数（视图函数）handler处理后的请求是stream流响应的实例，则直接返回给客户端
 		if isinstance(r, web.StreamResponse):
 			logging.info('return StreamResponse.')
@@ -94,15 +172,13 @@ async def response_factory(app,handler):
 				ensure_ascii:默认True，仅能输出ascii格式数据。故设置为False
 				#default: r对象会先被传入default中的函数进行处理，然后才被序列化为json对象
 				__dict__: 以dict形式返回对象属性和值的映射，一般的class实例都有一个__dict__属性'''
-				resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda obj: obj.__dict__).encode('utf-8'))
+				resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=json_default).encode('utf-8'))
 				resp.content_type = 'application/json;charset=utf-8'
 				return resp
 			else:
-				'''get_template()方法返回Template对象，调用其render()方法传入r渲染模板'''
+				'''get_template()方法返回Template对象，render_template用其generate()方法传入r分块渲染模板'''
 				r['__user__'] = request.__user__
-				resp = web.Response(body=app['__template__'].get_template(template).render(**r).encode('utf-8'))
-				resp.content_type = 'text/html;charset=utf-8'
-				return resp
+				return await render_template(request, app['__template__'].get_template(template), r)
 		#返回响应码
 		if isinstance(r, int) and (600>r>=100):
 			logging.info('return http number')
@@ -124,6 +200,12 @@ async def response_factory(app,handler):
 
 
 
+#初始化jinja2模板信息：debug时每次检查模板修改；否则关闭检查、启动时预编译所有模板并使用字节码缓存
+def init_templates(app, debug):
+	bytecode_cache = None if debug else (config.configs['templates']['bytecode_cache'] or webstructure.BYTECODE_CACHE)
+	init_jinja2(app, filters=dict(datetime=datetime_filter, static=assets.static_url), globals=dict(static=assets.static_url, bundle=assets.bundle),
+		auto_reload=debug, bytecode_cache=bytecode_cache, warmup=not debug)
+
 async def init(LOOP):
 	'''Application,构造函数 def __init__(self,*,logger=web_logger,loop=None,
 	                                     router=None,handler_factory=RequestHandlerFactory,
@@ -133,9 +215,13 @@ async def init(LOOP):
 	#middleware是一种拦截器，一个URL在被某个函数处理前，可以经过一系列的middleware处理
 	#详细定义在webstructure.py
 	await ormstructure.create_pool(LOOP,**config.configs['db'])
-	app = web.Application(loop=LOOP, middlewares=[logger, auth, response_factory])
+	#SQLite(本地压测/测试)启动时按Model建表
+	if ormstructure.backend() == 'sqlite':
+		await schema.create_all(Models.User, Models.Blog, Models.Comment)
+	#compress_response在最外层，压缩整页缓存命中和新渲染的响应；read_your_writes在auth之前(cookie2user的读也要走主库)；page_cache在auth之后(需要__user__)、response_factory之前(缓存渲染好的响应)
+	app = web.Application(loop=LOOP, middlewares=[logger, compress.compress_response, read_your_writes, auth, pagecache.page_cache, response_factory])
 	#初始化jinja2模板信息
-	init_jinja2(app, filters=dict(datetime=datetime_filter))
+	init_templates(app, config.configs['debug'])
 	#添加路径
 	add_routes(app,'handlers')
 
@@ -155,6 +241,12 @@ async def init(LOOP):
 	return srv
 
 if __name__ == '__main__':
+	#python app.py --compile-templates：部署时预先编译所有模板到字节码缓存，各进程启动时直接加载
+	if '--compile-templates' in sys.argv:
+		app = {}
+		init_templates(app, False)
+		print('compiled %s templates into %s' % (len(app['__template__'].list_templates()), config.configs['templates']['bytecode_cache'] or webstructure.BYTECODE_CACHE))
+		sys.exit(0)
 	#创建协程，LOOP = asyncio.get_event_loop()为asyncio.BaseEventLoop的对象，协程的基本单位
 	LOOP = asyncio.get_event_loop()
 	LOOP.run_until_complete(init(LOOP))
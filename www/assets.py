@@ -0,0 +1,145 @@
+# -*- coding:utf-8 -*-
+import os, re, json, hashlib, logging
+
+import compress
+
+#可选的压缩(minify)库：没有安装时css用下面的简单压缩，js不压缩(__base__.html用的大多已是.min.js)
+try:
+	import rcssmin
+except ImportError:
+	rcssmin = None
+try:
+	import rjsmin
+except ImportError:
+	rjsmin = None
+
+'''静态文件指纹(文件名带内容哈希)
+
+   python assets.py：把static/下的文件复制到static/dist/，文件名加上内容哈希，例如
+   css/awesome.css => dist/css/awesome.1a2b3c4d5e.css；css中url()引用的字体/图片改为带哈希的路径；
+   BUNDLES中的css/js先压缩再合并成一个文件；最后写出dist/manifest.json并生成.gz/.br预压缩文件
+
+   模板中用 {{ static('css/awesome.css') }} 或 {{ 'css/awesome.css'|static }} 得到带哈希的url，
+   {% for url in bundle('css/base.css') %} 得到合并文件的url(没有manifest时返回各个原文件)
+   dist/下的文件内容不会改变，add_static以Cache-Control: immutable, max-age=31536000返回'''
+
+STATIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST = 'dist'
+MANIFEST = os.path.join(STATIC, DIST, 'manifest.json')
+
+#__base__.html加载的css/js，按加载顺序合并
+BUNDLES = {
+	'css/base.css': ['css/uikit.min.css', 'css/uikit.gradient.min.css', 'css/awesome.css'],
+	'js/base.js': ['js/jquery.min.js', 'js/sha1.min.js', 'js/uikit.min.js', 'js/sticky.min.js', 'js/vue.min.js', 'js/awesome.js']
+}
+
+_RE_CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+_manifest = {}
+
+def load_manifest():
+	global _manifest
+	try:
+		with open(MANIFEST, encoding='utf-8') as f:
+			_manifest = json.load(f)
+	except FileNotFoundError:
+		logging.info('no asset manifest, serving unhashed static files.')
+		_manifest = {}
+	return _manifest
+
+def static_url(path, manifest=None):
+	'''static/下的相对路径 => url，有manifest时为带哈希的路径'''
+	return '/static/' + (_manifest if manifest is None else manifest).get(path, path)
+
+def bundle(name):
+	'''合并文件的url列表；没有构建过时返回组成它的各个原文件，开发时不需要构建'''
+	if name in _manifest:
+		return [static_url(name)]
+	return [static_url(path) for path in BUNDLES[name]]
+
+def minify_css(css):
+	if rcssmin is not None:
+		return rcssmin.cssmin(css)
+	#去掉注释，合并空白
+	css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+	css = re.sub(r'\s+', ' ', css)
+	#选择器中:前的空格有意义(div :first-child)，只去掉:后的空格
+	css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+	css = re.sub(r':\s+', ':', css)
+	return css.replace(';}', '}').strip()
+
+def minify_js(js):
+	if rjsmin is not None:
+		return rjsmin.jsmin(js)
+	return js
+
+def _hashed_name(path, data):
+	name, ext = os.path.splitext(path)
+	return '%s/%s.%s%s' % (DIST, name, hashlib.sha1(data).hexdigest()[:10], ext)
+
+def _write(manifest, path, data):
+	hashed = _hashed_name(path, data)
+	dst = os.path.join(STATIC, hashed)
+	if not os.path.exists(dst):
+		os.makedirs(os.path.dirname(dst), exist_ok=True)
+		with open(dst, 'wb') as f:
+			f.write(data)
+	manifest[path] = hashed
+
+def _rewrite_css(path, css, manifest):
+	'''把css中相对路径的url()改成带哈希的绝对路径，合并后文件位置改变也不影响'''
+	def repl(m):
+		url = m.group(2).strip()
+		if re.match(r'^(data:|[a-z]+:|//|/|#)', url):
+			return m.group(0)
+		target = re.split(r'[?#]', url, 1)[0]
+		suffix = url[len(target):]
+		ref = os.path.normpath(os.path.join(os.path.dirname(path), target)).replace(os.sep, '/')
+		if ref not in manifest:
+			return m.group(0)
+		return 'url(%s%s)' % (static_url(ref, manifest), suffix)
+	return _RE_CSS_URL.sub(repl, css)
+
+def build():
+	'''生成dist/和manifest.json，返回manifest；旧的带哈希文件保留，部署期间仍在运行的旧进程可以继续引用'''
+	manifest = {}
+	files = []
+	for root, dirs, names in os.walk(STATIC):
+		rel_root = os.path.relpath(root, STATIC).replace(os.sep, '/')
+		if rel_root == DIST or rel_root.startswith(DIST + '/'):
+			continue
+		for name in names:
+			if name.endswith(('.gz', '.br')) or name == 'README':
+				continue
+			files.append(name if rel_root == '.' else rel_root + '/' + name)
+	#先处理字体/图片等，css改写url()时需要它们带哈希的路径
+	minified = {}
+	for path in sorted(files, key=lambda p: p.endswith('.css')):
+		with open(os.path.join(STATIC, path), 'rb') as f:
+			data = f.read()
+		if path.endswith('.css'):
+			css = _rewrite_css(path, data.decode('utf-8'), manifest)
+			minified[path] = css if path.endswith('.min.css') else minify_css(css)
+			data = minified[path].encode('utf-8')
+		elif path.endswith('.js'):
+			js = data.decode('utf-8')
+			minified[path] = js if path.endswith('.min.js') else minify_js(js)
+			data = minified[path].encode('utf-8')
+		_write(manifest, path, data)
+	for name, paths in BUNDLES.items():
+		#js之间加;和换行，避免前一个文件没有以;结束
+		sep = '\n' if name.endswith('.css') else ';\n'
+		_write(manifest, name, sep.join([minified[p] for p in paths]).encode('utf-8'))
+	with open(MANIFEST, 'w', encoding='utf-8') as f:
+		json.dump(manifest, f, indent=1, sort_keys=True)
+	compress.build_static(os.path.join(STATIC, DIST))
+	return manifest
+
+load_manifest()
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO)
+	manifest = build()
+	for name in BUNDLES:
+		print('%s => %s' % (name, manifest[name]))
+	print('%s files, manifest: %s' % (len(manifest), MANIFEST))
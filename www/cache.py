@@ -0,0 +1,69 @@
+# -*- coding:utf-8 -*-
+import time
+
+from collections import OrderedDict
+
+class CacheBackend(object):
+	"""缓存后端的接口：查询结果缓存只依赖get/set，
+	实现这两个方法即可换成多进程共享的缓存(如memcached/redis的封装)"""
+	def get(self, key, default=None):
+		raise NotImplementedError
+
+	def set(self, key, value, ttl=None):
+		raise NotImplementedError
+
+'''进程内缓存：有容量上限的LRU + TTL过期(ttl=None则不过期，只按容量淘汰)
+   OrderedDict按访问顺序保存key，最近访问的移到末尾，超出容量时从头部淘汰'''
+
+class LRUCache(CacheBackend):
+	def __init__(self, maxsize=1024, ttl=300):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self._data = OrderedDict()
+
+	def get(self, key, default=None):
+		item = self._data.get(key, None)
+		if item is None:
+			return default
+		value, expires = item
+		#过期则删除
+		if expires < time.time():
+			del self._data[key]
+			return default
+		self._data.move_to_end(key)
+		return value
+
+	def set(self, key, value, ttl=None):
+		ttl = self.ttl if ttl is None else ttl
+		expires = float('inf') if ttl is None else time.time() + ttl
+		self._data[key] = (value, expires)
+		self._data.move_to_end(key)
+		while len(self._data) > self.maxsize:
+			#last=False从头部(最久未访问)弹出
+			self._data.popitem(last=False)
+
+	#修改已有的值但保留原来的过期时间，key不存在或已过期则忽略
+	def replace(self, key, value):
+		item = self._data.get(key, None)
+		if item is not None and item[1] >= time.time():
+			self._data[key] = (value, item[1])
+
+	def delete(self, key):
+		self._data.pop(key, None)
+
+	#按条件批量删除，match(key)返回True则删除
+	def delete_if(self, match):
+		for k in [k for k in self._data if match(k)]:
+			del self._data[k]
+
+	def keys(self):
+		return list(self._data.keys())
+
+	def clear(self):
+		self._data.clear()
+
+	def __contains__(self, key):
+		return self.get(key, None) is not None
+
+	def __len__(self):
+		return len(self._data)
@@ -0,0 +1,140 @@
+# -*- coding:utf-8 -*-
+import os, re, sys, gzip, logging
+
+from aiohttp import web
+from aiohttp.web import middleware
+from cache import LRUCache
+from config import configs
+
+#brotli是可选依赖，没有安装时只用gzip
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+'''响应压缩
+   compress_response：按Accept-Encoding协商br/gzip，压缩超过min_size的文本响应(html/json/css/js等)
+   压缩后的ETag加上-br/-gzip后缀(同一URL不同编码是不同的表示)，收到的If-None-Match去掉后缀再交给下层比较；
+   带ETag的响应(整页缓存命中)按(ETag, 编码)缓存压缩结果，相同内容只压缩一次
+
+   静态文件：python compress.py 为static/下的文本文件生成.gz(有brotli时还有.br)，
+   webstructure.add_static按Accept-Encoding直接返回这些预压缩文件，不占用请求时的CPU'''
+
+_COMPRESSIBLE = re.compile(r'^(text/|application/(json|javascript|xml)|image/svg\+xml)')
+_STATIC_EXTENSIONS = ('.css', '.js', '.html', '.txt', '.json', '.svg', '.xml', '.ttf', '.otf', '.eot')
+_RE_SUFFIX = re.compile(r'-(br|gzip)"')
+
+_conf = configs['compress']
+_COMPRESSED = LRUCache(_conf.get('cache_size', 256), _conf.get('cache_ttl', 300))
+
+def accepted_encodings(request):
+	'''Accept-Encoding中q>0的编码'''
+	result = set()
+	for item in request.headers.get('Accept-Encoding', '').lower().split(','):
+		parts = item.strip().split(';')
+		q = 1.0
+		for p in parts[1:]:
+			p = p.strip()
+			if p.startswith('q='):
+				try:
+					q = float(p[2:])
+				except ValueError:
+					q = 0.0
+		if parts[0] and q > 0:
+			result.add(parts[0])
+	return result
+
+def choose_encoding(request):
+	accepted = accepted_encodings(request)
+	if brotli is not None and ('br' in accepted or '*' in accepted):
+		return 'br'
+	if 'gzip' in accepted or '*' in accepted:
+		return 'gzip'
+	return None
+
+def compress(body, encoding, static=False):
+	if encoding == 'br':
+		return brotli.compress(body, quality=11 if static else _conf.get('brotli_quality', 5))
+	#mtime=0：相同内容压缩结果相同
+	return gzip.compress(body, 9 if static else _conf.get('gzip_level', 6), mtime=0)
+
+def _add_vary(resp):
+	vary = resp.headers.get('Vary')
+	if not vary:
+		resp.headers['Vary'] = 'Accept-Encoding'
+	elif 'accept-encoding' not in vary.lower():
+		resp.headers['Vary'] = vary + ', Accept-Encoding'
+
+@middleware
+async def compress_response(request, handler):
+	inm = request.headers.get('If-None-Match')
+	suffix = None
+	if inm and _RE_SUFFIX.search(inm):
+		suffix = _RE_SUFFIX.search(inm).group(1)
+		headers = request.headers.copy()
+		headers['If-None-Match'] = _RE_SUFFIX.sub('"', inm)
+		request = request.clone(headers=headers)
+	resp = await handler(request)
+	if type(resp) is not web.Response or 'Content-Encoding' in resp.headers:
+		return resp
+	etag = resp.headers.get('ETag')
+	if resp.status == 304:
+		#304没有响应体，ETag沿用客户端缓存的那种编码
+		if suffix and etag and etag.endswith('"'):
+			resp.headers['ETag'] = '%s-%s"' % (etag[:-1], suffix)
+			_add_vary(resp)
+		return resp
+	body = resp.body
+	if resp.status != 200 or not isinstance(body, bytes) or len(body) < _conf.get('min_size', 1024):
+		return resp
+	if not _COMPRESSIBLE.match(resp.content_type or ''):
+		return resp
+	_add_vary(resp)
+	encoding = choose_encoding(request)
+	if encoding is None:
+		return resp
+	data = None
+	if etag:
+		data = _COMPRESSED.get((etag, encoding))
+	if data is None:
+		data = compress(body, encoding)
+		if etag:
+			_COMPRESSED.set((etag, encoding), data)
+	resp.body = data
+	resp.headers['Content-Encoding'] = encoding
+	if etag and etag.endswith('"') and not etag.startswith('W/'):
+		resp.headers['ETag'] = '%s-%s"' % (etag[:-1], encoding)
+	return resp
+
+def build_static(path, force=False):
+	'''为path下的文本文件写.gz/.br预压缩文件，已是最新的跳过；返回写入的文件列表'''
+	written = []
+	encodings = [('gzip', '.gz')] + ([('br', '.br')] if brotli is not None else [])
+	for root, dirs, files in os.walk(path):
+		for name in files:
+			if not name.endswith(_STATIC_EXTENSIONS):
+				continue
+			src = os.path.join(root, name)
+			with open(src, 'rb') as f:
+				body = None
+				for encoding, ext in encodings:
+					dst = src + ext
+					if not force and os.path.exists(dst) and os.path.getmtime(dst) >= os.path.getmtime(src):
+						continue
+					if body is None:
+						body = f.read()
+					data = compress(body, encoding, static=True)
+					#压缩后没有变小的不保存，直接返回原文件
+					if len(data) >= len(body):
+						continue
+					with open(dst, 'wb') as out:
+						out.write(data)
+					written.append(dst)
+	return written
+
+if __name__ == '__main__':
+	if brotli is None:
+		logging.warning('brotli is not installed, only .gz files are written.')
+	static = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+	for dst in build_static(static, force='--force' in sys.argv):
+		print(dst)
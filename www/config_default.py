@@ -4,13 +4,52 @@
 configs = {
 	'debug': True,
 	'db':{
+		#'mysql'或'sqlite'，sqlite用于本地压测/测试，sqlite_path为数据库文件或:memory:
+		'backend':'mysql',
+		'sqlite_path':':memory:',
 		'host':'127.0.0.1',
 		'port':3306,
 		'user':'root',
 		'password':'xxxxxxxx',
 		'db':'awsome',
+		#只读副本，未写的项沿用上面主库的配置，例如 [{'host':'127.0.0.2'}]
+		'replicas':[],
+		#同一请求写入后多少秒内的读仍走主库
+		'read_your_writes':5,
+		#慢查询阈值(秒)，以及是否对慢查询执行一次EXPLAIN
+		'slow_query':0.5,
+		'explain_slow':False,
+		#取连接、执行语句的默认超时(秒)，超时返回503
+		'acquire_timeout':5,
+		'query_timeout':30
+	},
+	#匿名读者的整页缓存(pagecache.py)：最多缓存的页面数与有效时间(秒)
+	'page_cache':{
+		'size':512,
+		'ttl':60
+	},
+	#响应压缩(compress.py)：超过min_size字节的文本响应才压缩；按ETag缓存压缩结果
+	'compress':{
+		'min_size':1024,
+		'gzip_level':6,
+		'brotli_quality':5,
+		'cache_size':256,
+		'cache_ttl':300
+	},
+	#debug为False时：模板不检查修改、启动时预编译，字节码缓存在bytecode_cache目录(None为www/.jinja2_cache)
+	'templates':{
+		'bytecode_cache':None,
+		#渲染结果超过该大小(字符)时分块发送，0为只在handler要求时分块发送
+		'stream_threshold':65536
+	},
+	#/api/metrics的抓取令牌，None时只有管理员可以访问
+	'metrics':{
+		'token':None
 	},
 	'session':{
-		'secret':'asdfg'
+		'secret':'asdfg',
+		#session缓存的容量与有效时间(秒)
+		'cache_size':1024,
+		'cache_ttl':300
 	}
 }
@@ -1,10 +1,11 @@
 # -*- coding:utf-8 -*-
 from webstructure import get, post
 from aiohttp import web
-import asyncio, time, re, json, hashlib, base64, logging, markdown2
+import asyncio, time, re, json, hashlib, hmac, base64, logging, markdown2, metrics, ormstructure, pagecache
 from Models import Blog, User, next_id, Comment
-from ApiError import APIValueError, APIResourceNotFoundError,APIPermissionError, Page
+from ApiError import APIValueError, APIResourceNotFoundError,APIPermissionError, Page, CursorPage
 from config import configs
+from cache import LRUCache
 
 #匹配邮箱
 _RE_EMAIL = re.compile(r'^[a-z0-9\.\-\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$')
@@ -14,6 +15,8 @@ _RE_SHA1 = re.compile(r'^[0-9a-f]{40}$')
 COOKIE_NAME = 'awesession'
 #数据库保存的session
 _COOKIE_KEY = configs['session']['secret']
+#已验证的session缓存：key为cookie字符串(uid-expires-sha1)，省去每个请求一次users表查询
+_SESSION_CACHE = LRUCache(configs['session'].get('cache_size', 1024), configs['session'].get('cache_ttl', 300))
 
 def user2cookie(user, max_age):
 	#存储cookie的截止时间
@@ -36,6 +39,10 @@ async def cookie2user(cookie_str):
 		#如果截止时间小于现在的时间，代表cookie过期了
 		if int(expires) < time.time():
 			return None
+		cached = _SESSION_CACHE.get(cookie_str)
+		if cached is not None:
+			#返回副本，防止视图函数修改缓存中的user
+			return User(**cached)
 		user = await User.find(uid)
 		if user is None:
 			return None
@@ -44,11 +51,24 @@ async def cookie2user(cookie_str):
 			logging.info('invalid sha1')
 			return None
 		user.passwd = '******'
+		#缓存时间不超过cookie的截止时间
+		_SESSION_CACHE.set(cookie_str, User(**user), min(_SESSION_CACHE.ttl, int(expires) - time.time()))
 		return user
+	except ormstructure.DBTimeoutError:
+		#数据库超时不能当作未登录处理，交给response层返回503
+		raise
 	except Exception as e:
 		logging.exception(e)
 		return None
 
+#用户信息(密码/名字)变更后，使该用户所有已缓存的session失效
+def invalidate_user_sessions(uid):
+	_SESSION_CACHE.delete_if(lambda k: k.startswith(uid + '-'))
+
+#博客或其评论有修改：使匿名读者整页缓存中的首页、博客列表接口和该博客页面失效
+def invalidate_blog_pages(blog_id):
+	pagecache.invalidate('/', '/api/blogs*', '/blog/%s' % blog_id)
+
 #定义检查请求是否有用户以及该用户是否有权限的函数
 def check_admin(request):
 	if request.__user__ is None or not request.__user__.admin:
@@ -70,6 +90,14 @@ def text2html(text):
 		lambda s: s.strip() != '', text.split('\n')))
 	return ''.join(lines)
 
+def content_hash(content):
+	return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+#写入时渲染markdown，把html和content的摘要一起保存
+def render_blog(blog):
+	blog.html_content = markdown2.markdown(blog.content)
+	blog.content_hash = content_hash(blog.content)
+
 '''-----思路： 前端页面带有模板，具体操作响应用后端API处理，然后返回响应的页面'''
 
 #主页(根url)
@@ -81,7 +109,7 @@ async def index(*, page='1'):
 	if num == 0:
 		blogs = []
 	else:
-		blogs = await Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit))
+		blogs = await Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit), compact=True)
 	return {
 		'__template__': 'blogs.html',
 		'blogs': blogs,
@@ -119,10 +147,13 @@ async def get_blog(id):
 	comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
 	for c in comments:
 		c.html_content = text2html(c.content)
-	# markdown将txt转化成为html格式
-	blog.html_content = markdown2.markdown(blog.content)
+	# 优先使用保存时已渲染的html，缺失或content已改变时在内存中渲染；GET不写数据库，旧数据由repair.py html回填
+	if not blog.html_content or blog.content_hash != content_hash(blog.content):
+		render_blog(blog)
 	return {
 		'__template__': 'blog.html',
+		#评论可能很多，分块渲染发送
+		'__stream__': True,
 		'blog':blog,
 		'comments': comments
 	}
@@ -189,15 +220,38 @@ async def edit_user():
 
 #-------------------------------------后端api----------------------------------------
 
+#监控指标(Prometheus文本格式)：连接池等待时间、连接数、语句执行时间等
+#含表名和连接池状态：需要管理员权限，或请求头 Authorization: Bearer <configs['metrics']['token']>(供监控系统抓取)
+@get('/api/metrics')
+def api_metrics(request):
+	token = configs['metrics'].get('token', None)
+	if not (token and hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token)):
+		check_admin(request)
+	r = web.Response(body=metrics.render().encode('utf-8'))
+	r.content_type = 'text/plain'
+	r.charset = 'utf-8'
+	return r
+
+#按语句指纹统计的调用次数、耗时以及慢查询的EXPLAIN结果，需要管理员权限
+@get('/api/slow_queries')
+def api_slow_queries(request):
+	check_admin(request)
+	return dict(queries=ormstructure.slow_queries())
+
 #获取评论
 @get('/api/comments')
-async def api_comments(*, page='1'):
+async def api_comments(*, page='1', after=None):
+	#带after参数时使用游标分页(首页传after=)，不再需要count
+	if after is not None:
+		p = CursorPage(after)
+		comments = p.fill(await Comment.findAll(after=p.cursor, limit=p.limit, compact=True))
+		return dict(page=p, comments=comments)
 	page_index = get_page_index(page)
 	num = await Comment.findNumber('count(id)')
 	p = Page(num, page_index)
 	if num == 0:
 		return dict(page=p, comments=())
-	comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+	comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit), compact=True)
 	return dict(page=p, comments=comments)
 
 #删除评论，需要检查是否有权限
@@ -207,7 +261,13 @@ async def api_delete_comments(id, request):
 	c = await Comment.find(id)
 	if c is None:
 		raise APIResourceNotFoundError('Comment')
-	await c.delete()
+	#删除评论和更新博客的评论数在同一事务内；并发删除同一条评论时只有一个会减计数
+	async with ormstructure.transaction():
+		if await Comment.delete_where('`id`=?', [id]) == 1:
+			latest = await Comment.findAll('`blog_id`=?', [c.blog_id], orderBy='`created_at` desc', limit=1, columns=['created_at'])
+			last = latest[0].created_at if latest else None
+			await Blog.update_where(dict(last_commented_at=last), '`id`=?', [c.blog_id], incr=dict(comment_count=-1))
+	invalidate_blog_pages(c.blog_id)
 	return dict(id=id)
 
 #创建某篇博客的评论
@@ -222,18 +282,25 @@ async def api_create_comment(id, request, *, content):
 	if blog is None:
 		raise APIResourceNotFoundError('Blog')
 	comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content.strip())
-	await comment.save()
+	async with ormstructure.transaction():
+		await comment.save()
+		await Blog.update_where(dict(last_commented_at=comment.created_at), '`id`=?', [blog.id], incr=dict(comment_count=1))
+	invalidate_blog_pages(blog.id)
 	return comment
 
 #获取博客
 @get('/api/blogs')
-async def api_blogs(*, page='1'):
+async def api_blogs(*, page='1', after=None):
+	if after is not None:
+		p = CursorPage(after)
+		blogs = p.fill(await Blog.findAll(after=p.cursor, limit=p.limit, compact=True))
+		return dict(page=p, blogs=blogs)
 	page_index = get_page_index(page)
 	num = await Blog.findNumber('count(id)')
 	p = Page(num, page_index)
 	if num == 0:
 		return dict(page=p, blogs=())
-	blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+	blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit), compact=True)
 	return dict(page=p, blogs=blogs)
 
 #获取某篇博客
@@ -253,18 +320,27 @@ async def api_update_blog(id, request, *, name, summary, content):
 	if not content or not content.strip():
 		raise APIValueError('content', 'content cannot be empty.')
 	blog = await Blog.find(id)
+	if blog is None:
+		raise APIResourceNotFoundError('Blog')
 	blog.name = name.strip()
 	blog.summary = summary.strip()
 	blog.content = content.strip()
-	await blog.update()
+	render_blog(blog)
+	#只写修改的列：blog可能来自查询缓存，整行update()会把期间变化的comment_count/last_commented_at改回旧值
+	await Blog.update_where(dict(name=blog.name, summary=blog.summary, content=blog.content, html_content=blog.html_content, content_hash=blog.content_hash), '`id`=?', [id])
+	invalidate_blog_pages(id)
 	return blog
 
 #删除某篇博客
 @post('/api/blogs/{id}/delete')
 async def api_delete_blog(request, *, id):
 	check_admin(request)
-	blog = await Blog.find(id)
-	await blog.delete()
+	#同一事务内删除博客及其评论，不需要先find
+	async with ormstructure.transaction():
+		if await Blog.delete_where('`id`=?', [id]) == 0:
+			raise APIResourceNotFoundError('Blog')
+		await Comment.delete_where('`blog_id`=?', [id])
+	invalidate_blog_pages(id)
 	return dict(id=id)
 
 #创建博客，由/manage/blogs中action跳转处理
@@ -279,7 +355,9 @@ async def api_create_blog(request, *, name, summary, content):
 		raise APIValueError('content', 'content cannot be empty.')
 	blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image,
 		name=name.strip(), summary=summary.strip(), content=content.strip())
+	render_blog(blog)
 	await blog.save()
+	invalidate_blog_pages(blog.id)
 	return blog
 
 #登陆验证邮箱与密码是否正确，由登陆页get/signin中的action跳转至此处理
@@ -310,7 +388,13 @@ async def authenticate(*, email, passwd):
 
 #获取用户
 @get('/api/users')
-async def api_get_users(*, page='1'):
+async def api_get_users(*, page='1', after=None):
+	if after is not None:
+		p = CursorPage(after)
+		users = p.fill(await User.findAll(after=p.cursor, limit=p.limit))
+		for u in users:
+			u.passwd = '******'
+		return dict(page=p, users=users)
 	page_index = get_page_index(page)
 	num = await User.findNumber('count(id)')
 	p = Page(num, page_index)
@@ -368,6 +452,7 @@ async def api_update_user(*, id, name, oldpasswd, newpasswd):
 	sha1_passwd = '%s:%s' % (id, newpasswd)
 	user.passwd = hashlib.sha1(sha1_passwd.encode('utf-8')).hexdigest()
 	await user.update()
+	invalidate_user_sessions(id)
 	r = web.Response()
 	r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
 	user.passwd = '******'
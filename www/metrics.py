@@ -0,0 +1,66 @@
+# -*- coding:utf-8 -*-
+'''简单的监控指标：直方图(Histogram)和回调式的Gauge
+   render()按Prometheus文本格式输出所有指标，供监控系统抓取'''
+
+#默认的桶(秒)，覆盖1ms到10s
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+def _format_labels(labels):
+	if not labels:
+		return ''
+	return '{%s}' % ','.join(['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels])
+
+class Histogram(object):
+	def __init__(self, name, doc, buckets=DEFAULT_BUCKETS):
+		self.name = name
+		self.doc = doc
+		self.buckets = tuple(buckets)
+		#key为排序后的标签元组，value为[各桶计数, 总和, 总数]
+		self._series = {}
+		_registry.append(self)
+
+	def observe(self, value, **labels):
+		key = tuple(sorted(labels.items()))
+		series = self._series.get(key, None)
+		if series is None:
+			series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+		for i, bound in enumerate(self.buckets):
+			if value <= bound:
+				series[0][i] += 1
+				break
+		series[1] += value
+		series[2] += 1
+
+	def render(self):
+		L = ['# HELP %s %s' % (self.name, self.doc), '# TYPE %s histogram' % self.name]
+		for key, (counts, total, num) in self._series.items():
+			acc = 0
+			for bound, c in zip(self.buckets, counts):
+				acc += c
+				L.append('%s_bucket%s %s' % (self.name, _format_labels(key + (('le', repr(bound)),)), acc))
+			L.append('%s_bucket%s %s' % (self.name, _format_labels(key + (('le', '+Inf'),)), num))
+			L.append('%s_sum%s %s' % (self.name, _format_labels(key), total))
+			L.append('%s_count%s %s' % (self.name, _format_labels(key), num))
+		return L
+
+class Gauge(object):
+	"""抓取时才调用fn取值，fn返回[(标签dict, 值), ...]"""
+	def __init__(self, name, doc, fn):
+		self.name = name
+		self.doc = doc
+		self.fn = fn
+		_registry.append(self)
+
+	def render(self):
+		L = ['# HELP %s %s' % (self.name, self.doc), '# TYPE %s gauge' % self.name]
+		for labels, value in self.fn():
+			L.append('%s%s %s' % (self.name, _format_labels(tuple(sorted(labels.items()))), value))
+		return L
+
+def render():
+	L = []
+	for m in _registry:
+		L.extend(m.render())
+	return '\n'.join(L) + '\n'
@@ -1,5 +1,14 @@
 # -*- coding:utf-8 -*-
-import asyncio, aiomysql, logging
+import asyncio, logging, contextlib, contextvars, time, re
+
+#只用SQLite后端时可以不安装aiomysql
+try:
+	import aiomysql
+except ImportError:
+	aiomysql = None
+
+from cache import LRUCache
+from metrics import Histogram, Gauge
 
 #异步编程原则：系统每一层都必须异步
 #aiomysql为MySQL提供了异步IO驱动
@@ -21,13 +30,81 @@ import asyncio, aiomysql, logging
 
 #定义日志输出函数Log，方便查看
 logging.basicConfig(level=logging.INFO)
+#每条语句都用INFO输出太多，只在DEBUG级别输出；慢查询见下面的慢查询记录
 def log(sql, args=()):
-	logging.info('SQL: %s' %sql)
+	logging.debug('SQL: %s' %sql)
+
+
+'''读写分离：configs['db']中可声明只读副本
+   'replicas': [dict(host='10.0.0.2'), dict(host='10.0.0.3', port=3307)]
+   每个副本的配置未写的项沿用主库的配置
+   select/stream走当前未完成连接数最少的副本；execute和事务内的语句走主库
+   客户端写入后read_your_writes秒内，该客户端的读也走主库，避免读到复制延迟前的旧数据：
+   _last_write是当前客户端最近一次写入的时间，每个请求开始时由app.py的read_your_writes中间件
+   从cookie中恢复(set_last_write)，请求中有写入时再把新的时间写回cookie，因此对该客户端之后的请求也有效'''
+__pool = None
+__replicas = []
+#每个pool当前未完成(正在使用或等待)的连接数
+_outstanding = {}
+_read_your_writes = 5
+_last_write = contextvars.ContextVar('_last_write', default=0)
+
+def read_your_writes_window():
+	return _read_your_writes
 
+def last_write():
+	return _last_write.get()
+
+def set_last_write(t):
+	_last_write.set(t)
+
+'''数据库后端：configs['db']['backend']为'mysql'(默认，aiomysql)或'sqlite'(aiosqlite，见sqlite_backend.py)
+   _driver提供Cursor/DictCursor/SSDictCursor游标类，pool和连接的用法两者相同'''
+_driver = aiomysql
+_backend = 'mysql'
+
+def backend():
+	return _backend
 
 async def create_pool(LOOP, **kw):
 	logging.info('create database connection pool...')
-	global __pool
+	global __pool, __replicas, _read_your_writes, _driver, _backend
+	_backend = kw.get('backend', 'mysql')
+	if _backend == 'sqlite':
+		import sqlite_backend
+		_driver = sqlite_backend
+		__pool = await sqlite_backend.create_pool(kw.get('sqlite_path', ':memory:'), kw.get('maxsize', 5))
+	else:
+		_driver = aiomysql
+		__pool = await _create_pool(LOOP, kw)
+	_pool_names[__pool] = 'primary'
+	__replicas = []
+	for r in (kw.get('replicas', ()) if _backend == 'mysql' else ()):
+		logging.info('create replica connection pool: %s' % r.get('host', kw.get('host', 'localhost')))
+		pool = await _create_pool(LOOP, dict(kw, **r))
+		_pool_names[pool] = 'replica%s' % len(__replicas)
+		__replicas.append(pool)
+	_read_your_writes = kw.get('read_your_writes', 5)
+	_slow_log.threshold = kw.get('slow_query', 0.5)
+	_slow_log.explain = kw.get('explain_slow', False)
+	_timeouts.update(acquire=kw.get('acquire_timeout', 5), query=kw.get('query_timeout', 30))
+
+#关闭主库和所有副本的连接池；命令行脚本结束前必须调用，aiosqlite的工作线程不是daemon线程，不关闭进程不会退出
+async def close_pool():
+	global __pool, __replicas
+	pools = ([__pool] if __pool is not None else []) + __replicas
+	__pool = None
+	__replicas = []
+	for pool in pools:
+		_pool_names.pop(pool, None)
+		_outstanding.pop(pool, None)
+		if _backend == 'sqlite':
+			await pool.close()
+		else:
+			pool.close()
+			await pool.wait_closed()
+
+async def _create_pool(LOOP, kw):
 	'''
 	aiomysql.create_pool(minisize=1,maxsize=10,loop=None,**kw)
 	
@@ -37,7 +114,7 @@ async def create_pool(LOOP, **kw):
 	      loop:an optional event loop instance
 	      **kw:接受所有的字典参数，包括前面的默认参数也可用字典参数形式传入
 	'''
-	__pool = await aiomysql.create_pool(
+	return await aiomysql.create_pool(
 		host=kw.get('host','localhost'),
 		port=kw.get('port',3306),
 		user=kw['user'],
@@ -49,41 +126,474 @@ async def create_pool(LOOP, **kw):
 		minsize=kw.get('minsize',1),
 		loop=LOOP)
 
+#事务中固定使用的连接：transaction()内的select/execute都走这个连接，由contextvar按协程隔离
+_tx_conn = contextvars.ContextVar('_tx_conn', default=None)
+#后台任务(EXPLAIN、KILL QUERY、FindLoader的批量查询)：在空的context中创建，不继承调用方的事务连接等contextvar；
+#事件循环只保存任务的弱引用，这里保留强引用直到任务结束
+_detached_tasks = set()
+
+def _spawn_detached(coro):
+	task = contextvars.Context().run(asyncio.ensure_future, coro)
+	_detached_tasks.add(task)
+	task.add_done_callback(_detached_tasks.discard)
+	return task
+
+#事务内的写入[(表, 行数变化)]：提交后才调整计数缓存、使查询缓存失效，回滚则丢弃(见_table_changed)
+_tx_changes = contextvars.ContextVar('_tx_changes', default=None)
+
+'''连接池与语句的监控指标，通过metrics.render()输出(见handlers的/api/metrics)
+   db_pool_acquire_seconds: 等待取得连接的时间，按pool分
+   db_query_seconds: 语句执行时间，按表(即model)和操作(select/insert/update/delete)分
+   db_pool_connections: 各pool使用中/空闲/等待中的连接数，抓取时读取'''
+_pool_names = {}
+_acquire_seconds = Histogram('db_pool_acquire_seconds', 'Time spent waiting for a pooled connection.')
+_query_seconds = Histogram('db_query_seconds', 'Statement execution time.')
+
+def _pool_connections():
+	L = []
+	for pool, name in _pool_names.items():
+		in_use = pool.size - pool.freesize
+		L.append((dict(pool=name, state='in_use'), in_use))
+		L.append((dict(pool=name, state='free'), pool.freesize))
+		L.append((dict(pool=name, state='waiting'), max(_outstanding.get(pool, 0) - in_use, 0)))
+	return L
+
+Gauge('db_pool_connections', 'Connections per pool by state.', _pool_connections)
+
+#从语句中取出操作和表名作为标签，按语句缓存
+_RE_TABLE = re.compile(r'(?:from|into|update)\s+`?(\w+)`?', re.IGNORECASE)
+_statement_labels = LRUCache(maxsize=4096, ttl=None)
+
+def _statement_label(sql):
+	label = _statement_labels.get(sql, None)
+	if label is None:
+		m = _RE_TABLE.search(sql)
+		op = sql.split(None, 1)[0].lower() if sql.strip() else ''
+		label = (m.group(1) if m else '', op)
+		_statement_labels.set(sql, label)
+	return label
+
+def _observe_query(sql, args, start):
+	elapsed = time.time() - start
+	model, op = _statement_label(sql)
+	_query_seconds.observe(elapsed, model=model, operation=op)
+	_slow_log.record(sql, args, elapsed)
+
+'''慢查询记录：把语句归一化成指纹(字面值、占位符换成?，in列表合并)，按指纹统计调用次数和总耗时
+   超过threshold秒的语句输出WARNING日志；explain=True时每个指纹第一次变慢时异步执行一次EXPLAIN并保存结果'''
+_RE_FP_STRING = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_RE_FP_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_RE_FP_PLACEHOLDER = re.compile(r'%s|\?')
+_RE_FP_IN = re.compile(r'\bin\s*\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_RE_FP_SPACE = re.compile(r'\s+')
+
+def fingerprint(sql):
+	fp = _RE_FP_STRING.sub('?', sql)
+	fp = _RE_FP_PLACEHOLDER.sub('?', fp)
+	fp = _RE_FP_NUMBER.sub('?', fp)
+	fp = _RE_FP_SPACE.sub(' ', fp).strip().lower()
+	return _RE_FP_IN.sub('in (...)', fp)
+
+class SlowQueryLog(object):
+	def __init__(self, threshold=0.5, explain=False):
+		self.threshold = threshold
+		self.explain = explain
+		#指纹 ==> dict(calls, total, max, slow, explain)
+		self.stats = {}
+		self._fingerprints = LRUCache(maxsize=4096, ttl=None)
+
+	def _fingerprint(self, sql):
+		fp = self._fingerprints.get(sql, None)
+		if fp is None:
+			fp = fingerprint(sql)
+			self._fingerprints.set(sql, fp)
+		return fp
+
+	def record(self, sql, args, elapsed):
+		fp = self._fingerprint(sql)
+		st = self.stats.get(fp, None)
+		if st is None:
+			st = self.stats[fp] = dict(calls=0, total=0.0, max=0.0, slow=0, explain=None)
+		st['calls'] += 1
+		st['total'] += elapsed
+		st['max'] = max(st['max'], elapsed)
+		if self.threshold is None or elapsed < self.threshold:
+			return
+		st['slow'] += 1
+		#只输出指纹和参数个数：参数里可能有密码哈希、用户内容等，不能写进日志
+		logging.warning('slow query (%.3fs): %s (%s args)' % (elapsed, fp, len(args) if isinstance(args, (list, tuple, dict)) else int(args is not None)))
+		if self.explain and st['explain'] is None and fp.startswith('select'):
+			st['explain'] = []
+			#不占用调用方的事务连接
+			_spawn_detached(self._explain(fp, sql, args))
+
+	async def _explain(self, fp, sql, args):
+		try:
+			rs = await select(CompiledSQL('explain ' + compile_sql(sql)), args)
+			self.stats[fp]['explain'] = [dict(r) for r in rs]
+			logging.warning('explain %s: %s' % (fp, self.stats[fp]['explain']))
+		except Exception as e:
+			logging.exception(e)
+
+	#按总耗时从大到小排列的统计
+	def top(self, n=50):
+		items = sorted(self.stats.items(), key=lambda kv: kv[1]['total'], reverse=True)[:n]
+		return [dict(fingerprint=fp, **st) for fp, st in items]
+
+_slow_log = SlowQueryLog()
+
+def slow_queries(n=50):
+	return _slow_log.top(n)
+
+'''超时：取连接(acquire)和执行语句(query)都有默认超时(秒，configs['db']中的acquire_timeout/query_timeout)
+   select/execute可用timeout=单独指定语句超时；with ormstructure.timeouts(acquire=1, query=2): 覆盖一段代码内的设置
+   语句超时后在服务器上KILL QUERY并丢弃该连接，两种超时都抛出DBTimeoutError(响应层返回503)'''
+class DBTimeoutError(Exception):
+	pass
+
+_timeouts = dict(acquire=5, query=30)
+_timeout_override = contextvars.ContextVar('_timeout_override', default=None)
+
+@contextlib.contextmanager
+def timeouts(acquire=None, query=None):
+	current = dict(_timeout_override.get() or {})
+	if acquire is not None:
+		current['acquire'] = acquire
+	if query is not None:
+		current['query'] = query
+	token = _timeout_override.set(current)
+	try:
+		yield
+	finally:
+		_timeout_override.reset(token)
+
+def _timeout(kind, timeout=None):
+	if timeout is not None:
+		return timeout
+	override = _timeout_override.get()
+	if override and kind in override:
+		return override[kind]
+	return _timeouts[kind]
+
+async def _get_conn(pool):
+	return await pool
+
+#从pool取连接，同时统计该pool未完成的连接数和等待时间
+@contextlib.asynccontextmanager
+async def _acquire(pool):
+	_outstanding[pool] = _outstanding.get(pool, 0) + 1
+	start = time.time()
+	try:
+		timeout = _timeout('acquire')
+		try:
+			ctx = await asyncio.wait_for(_get_conn(pool), timeout) if timeout else await pool
+		except asyncio.TimeoutError:
+			raise DBTimeoutError('acquire connection from pool %s timed out after %ss' % (_pool_names.get(pool, ''), timeout))
+		# pool常用的连接方式
+		with ctx as conn:
+			_acquire_seconds.observe(time.time() - start, pool=_pool_names.get(pool, ''))
+			#记录连接所属的pool，超时后KILL QUERY需要连到同一台服务器
+			conn._orm_pool = pool
+			yield conn
+	finally:
+		_outstanding[pool] -= 1
+
+#带超时执行coro(一次select/execute)，超时则终止服务器上的语句
+async def _run(conn, coro, sql, args, timeout=None):
+	timeout = _timeout('query', timeout)
+	if not timeout:
+		return await coro
+	start = time.time()
+	try:
+		return await asyncio.wait_for(coro, timeout)
+	except asyncio.TimeoutError:
+		#语句被取消时_select/_execute来不及记录，超时的语句也要计入耗时统计和慢查询记录
+		_observe_query(sql, args, start)
+		await _kill(conn)
+		raise DBTimeoutError('query timed out after %ss: %s' % (timeout, sql))
+
+async def _kill(conn):
+	if _backend == 'sqlite':
+		await conn.interrupt()
+		return
+	#连接的协议状态已不确定，关闭后pool不会再使用它；用另一个连接终止服务器上的语句
+	thread_id = conn.thread_id()
+	pool = getattr(conn, '_orm_pool', __pool)
+	conn.close()
+	async def kill():
+		try:
+			with timeouts(acquire=1, query=5):
+				async with _acquire(pool) as c:
+					cur = await c.cursor()
+					await cur.execute('kill query %d' % thread_id)
+					await cur.close()
+		except Exception as e:
+			logging.warning('failed to kill query %s: %s' % (thread_id, e))
+	_spawn_detached(kill())
+
+#事务连接同一时间只能执行一条语句：块内用asyncio.gather等并发执行语句时，驱动的协议状态会错乱，直接报错
+@contextlib.contextmanager
+def _pinned(conn):
+	if getattr(conn, '_orm_busy', False):
+		raise RuntimeError('transaction connection is already in use by another statement; statements inside transaction() must not run concurrently.')
+	conn._orm_busy = True
+	try:
+		yield conn
+	finally:
+		conn._orm_busy = False
+
+def _recent_write():
+	return time.time() - _last_write.get() < _read_your_writes
+
+#读操作使用的pool：没有副本或刚写入过时用主库，否则选未完成连接数最少的副本
+def _read_pool():
+	if not __replicas or _recent_write():
+		return __pool
+	return min(__replicas, key=lambda p: _outstanding.get(p, 0))
+
 #封装sql的select语句
-async def select(sql, args, size=None):
+#as_tuple=True时使用普通Cursor，每行返回元组而不是dict
+async def select(sql, args, size=None, as_tuple=False, timeout=None):
 	#log(sql,args)
-	global __pool
-	# pool常用的连接方式
-	with (await __pool) as conn:
-		#DictCursor返回一个字典形式的结果,其余操作和Cursor不变
-		cur = await conn.cursor(aiomysql.DictCursor)
-		'''sql语句占位符是？，MySQL的占位符是%s
-		   execute(query:SQL语句, args=None:SQL语句的参数--元组或列表)'''
-		await cur.execute(sql.replace('?','%s'),args or ())
-		if size:
-			#返回size行内容(元组组成的列表),不足size全部返回,如果没有则返回空列表
+	conn = _tx_conn.get()
+	if conn is not None:
+		with _pinned(conn):
+			return await _run(conn, _select(conn, sql, args, size, as_tuple), sql, args, timeout)
+	async with _acquire(_read_pool()) as conn:
+		return await _run(conn, _select(conn, sql, args, size, as_tuple), sql, args, timeout)
+
+async def _select(conn, sql, args, size=None, as_tuple=False):
+	#DictCursor返回一个字典形式的结果,其余操作和Cursor不变
+	start = time.time()
+	cur = await conn.cursor(_driver.Cursor if as_tuple else _driver.DictCursor)
+	'''sql语句占位符是？，MySQL的占位符是%s，由compile_sql转换
+	   execute(query:SQL语句, args=None:SQL语句的参数--元组或列表)'''
+	await cur.execute(compile_sql(sql),args or ())
+	if size:
+		#返回size行内容(元组组成的列表),不足size全部返回,如果没有则返回空列表
+		rs = await cur.fetchmany(size)
+	else:
+		#返回所有行内容
+		rs = await cur.fetchall()
+	await cur.close()
+	_observe_query(sql, args, start)
+	#logging.info('rows returned: %s' % len(rs))
+	return rs
+
+#流式select：使用不缓冲的服务端游标，每次fetchmany(size)行并yield，直到取完
+#事务内使用事务的连接；遍历期间该连接不能再执行其它语句
+async def stream(sql, args, size=1000):
+	conn = _tx_conn.get()
+	if conn is not None:
+		with _pinned(conn):
+			async for rs in _stream(conn, sql, args, size):
+				yield rs
+		return
+	async with _acquire(_read_pool()) as conn:
+		async for rs in _stream(conn, sql, args, size):
+			yield rs
+
+async def _stream(conn, sql, args, size):
+	start = time.time()
+	cur = await conn.cursor(_driver.SSDictCursor)
+	try:
+		await cur.execute(compile_sql(sql), args or ())
+		while True:
 			rs = await cur.fetchmany(size)
-		else:
-			#返回所有行内容
-			rs = await cur.fetchall()
+			if not rs:
+				break
+			yield rs
+	finally:
 		await cur.close()
-		#logging.info('rows returned: %s' % len(rs))
-		return rs
+		_observe_query(sql, args, start)
 
 #封装sql的其它执行语句，比如增加，删除等操作
-async def execute(sql,args):
+async def execute(sql,args,timeout=None):
 	#log(sql,args)
-	with (await __pool) as conn:
+	_last_write.set(time.time())
+	conn = _tx_conn.get()
+	if conn is not None:
+		#事务内不单独提交，由transaction()退出时统一commit
+		with _pinned(conn):
+			return await _run(conn, _execute(conn, sql, args), sql, args, timeout)
+	async with _acquire(__pool) as conn:
+		affected = await _run(conn, _execute(conn, sql, args), sql, args, timeout)
+		await conn.commit()
+		return affected
+
+async def _execute(conn, sql, args):
+	start = time.time()
+	cur = await conn.cursor()
+	#args为None时驱动不做格式化，编译后的%%不会被还原，因此传入空元组
+	await cur.execute(compile_sql(sql),args if args is not None else ())
+	'''rowcount返查询结果的行数,如果-1则表示没有结果集'''
+	affected = cur.rowcount
+	await cur.close()
+	_observe_query(sql, args, start)
+	return affected
+
+'''事务/工作单元：
+   async with ormstructure.transaction():
+       await a.save()
+       await b.update()
+   块内所有select/execute共用一个连接，正常退出时提交一次，出现异常则回滚
+   嵌套使用时并入最外层的事务
+   块内的语句必须依次await，不能用asyncio.gather等并发执行(块内创建的任务会继承事务连接)，
+   并发使用事务连接时抛出RuntimeError'''
+@contextlib.asynccontextmanager
+async def transaction():
+	conn = _tx_conn.get()
+	if conn is not None:
+		yield conn
+		return
+	async with _acquire(__pool) as conn:
+		await conn.begin()
+		token = _tx_conn.set(conn)
+		changes = []
+		changes_token = _tx_changes.set(changes)
 		try:
-			cur = await conn.cursor()
-			await cur.execute(sql.replace('?','%s'),args)
-			'''rowcount返查询结果的行数,如果-1则表示没有结果集'''
-			affected = cur.rowcount
+			yield conn
 			await conn.commit()
-			await cur.close()
-		except BaseException as e:
+			#提交后其它请求才能读到新数据，此时再调整/失效缓存；提交前失效的话，并发的读会把旧数据缓存到新版本下
+			for table, delta in changes:
+				_apply_change(table, delta)
+		except BaseException:
+			#语句超时后连接已被关闭，回滚失败不能掩盖原来的异常
+			try:
+				await conn.rollback()
+			except Exception as e:
+				logging.warning('rollback failed: %s' % e)
 			raise
-		return affected
+		finally:
+			_tx_changes.reset(changes_token)
+			_tx_conn.reset(token)
+
+'''findNumber的计数缓存：key为(table, selectField, where, args)
+   实现类设置 __count_ttl__ = 秒数 后启用，该值即允许的最大陈旧时间
+   本进程内的save/delete对无条件的count直接加减，带where条件的则失效'''
+_count_cache = LRUCache(maxsize=1024)
+
+#每个表计数缓存的修改次数，查询期间有修改的结果不写入缓存
+_count_versions = {}
+#表名 ==> 主键，由ModelMetaclass登记
+_primary_keys = {}
+
+#只有count(*)、count(1)、count(主键)随插入/删除的行数增减；count(distinct ...)、count(可为空的列)等只能失效
+def _row_count_field(table, selectField):
+	inner = selectField.replace(' ', '').replace('`', '').lower()
+	return inner in ('count(*)', 'count(1)', 'count(%s)' % _primary_keys.get(table, '').lower())
+
+def _adjust_counts(table, delta):
+	_count_versions[table] = _count_versions.get(table, 0) + 1
+	for key in _count_cache.keys():
+		if key[0] != table:
+			continue
+		if delta and key[2] is None and _row_count_field(table, key[1]):
+			num = _count_cache.get(key)
+			if num is not None:
+				_count_cache.replace(key, num + delta)
+		else:
+			_count_cache.delete(key)
+
+'''查询结果缓存：实现类设置 __cache_ttl__ = 秒数 后，find/find_many/findAll/findNumber的结果行被缓存
+   key中带有该表的版本号，表有写入时更新版本号即让该表所有旧的缓存失效，
+   因此后端只需要get/set(见cache.CacheBackend)，可用set_query_cache()换成共享缓存
+   版本号用时间戳，即使版本号被淘汰，重新生成的值也比旧的大'''
+_query_cache = LRUCache(maxsize=4096)
+
+def set_query_cache(backend):
+	global _query_cache
+	_query_cache = backend
+
+def _table_version(table):
+	version = _query_cache.get(('__version__', table))
+	if version is None:
+		version = time.time()
+		_query_cache.set(('__version__', table), version, 86400)
+	return version
+
+def _invalidate_table(table):
+	version = _query_cache.get(('__version__', table)) or 0
+	_query_cache.set(('__version__', table), max(time.time(), version + 0.000001), 86400)
+
+async def _cached_select(cls, sql, args, size=None, as_tuple=False):
+	ttl = getattr(cls, '__cache_ttl__', None)
+	#事务内的读需要看到未提交的写，不走缓存
+	if not ttl or _query_cache is None or _tx_conn.get() is not None:
+		return await select(sql, args, size, as_tuple)
+	version = _table_version(cls.__table__)
+	#表刚有写入时副本可能还没复制到，读到的旧数据不能缓存到新版本下
+	if __replicas and time.time() - version < _read_your_writes:
+		return await select(sql, args, size, as_tuple)
+	key = (cls.__table__, version, sql, tuple(args or ()), size, as_tuple)
+	rs = _query_cache.get(key)
+	if rs is None:
+		rs = await select(sql, args, size, as_tuple)
+		_query_cache.set(key, rs, ttl)
+	return rs
+
+#表有写入：调整计数缓存，并使查询结果缓存失效
+#事务外的execute返回时已经提交，直接处理；事务内先记下，由transaction()在提交后处理
+def _table_changed(table, delta):
+	changes = _tx_changes.get()
+	if changes is not None:
+		changes.append((table, delta))
+	else:
+		_apply_change(table, delta)
+
+def _apply_change(table, delta):
+	_adjust_counts(table, delta)
+	if _query_cache is not None:
+		_invalidate_table(table)
+
+'''sql编译：把?占位符转换成驱动的%s占位符
+   驱动会对语句做 % 格式化，所以字面的%要写成%%；引号内的?是字面值，不转换
+   编译结果是CompiledSQL(str的子类)，再次传入select/execute时直接使用；
+   按原始语句或查询形状(where/orderBy/limit形式等)缓存，相同形状只编译一次'''
+class CompiledSQL(str):
+	pass
+
+_sql_cache = LRUCache(maxsize=4096, ttl=None)
+
+def _compile(sql):
+	L = []
+	quote = None
+	escaped = False
+	for ch in sql:
+		if ch == '%':
+			L.append('%%')
+			continue
+		if quote:
+			if escaped:
+				escaped = False
+			elif ch == '\\':
+				escaped = True
+			elif ch == quote:
+				quote = None
+			L.append(ch)
+		elif ch in ('\'', '"', '`'):
+			quote = ch
+			L.append(ch)
+		elif ch == '?':
+			L.append('%s')
+		else:
+			L.append(ch)
+	return CompiledSQL(''.join(L))
+
+def _cache_sql(key, build):
+	sql = _sql_cache.get(key, None)
+	if sql is None:
+		sql = _compile(build())
+		_sql_cache.set(key, sql)
+	return sql
+
+def compile_sql(sql):
+	if isinstance(sql, CompiledSQL):
+		return sql
+	return _cache_sql(sql, lambda: sql)
+
+def _freeze(names):
+	return None if names is None else tuple(names)
 
 #函数定义：添加sql语句的占位符:?，在metaclass中的底层运用
 def create_args_string(num):
@@ -93,12 +603,14 @@ def create_args_string(num):
 	return ', '.join(L)
 
 class Field(object):
-#column_type为数据类型
-	def __init__(self, name, column_type, primary_key, default):
+#column_type为数据类型，index/unique声明该列的(唯一)二级索引，用于生成DDL(见schema.py)
+	def __init__(self, name, column_type, primary_key, default, index=False, unique=False):
 		self.name = name
 		self.column_type = column_type
 		self.primary_key = primary_key
 		self.default = default
+		self.index = index
+		self.unique = unique
 	
 	def __str__(self):
 		return '<%s, %s:%s>' % (self.__class__.__name__, self.column_type, self.name)
@@ -106,30 +618,79 @@ class Field(object):
 
 class StringField(Field):
 	"""映射varchar的StringField"""
-	def __init__(self, name=None, primary_key=False, default=None, c_type='varchar(100)'):
-		super().__init__(name, c_type, primary_key, default)
+	def __init__(self, name=None, primary_key=False, default=None, c_type='varchar(100)', index=False, unique=False):
+		super().__init__(name, c_type, primary_key, default, index, unique)
 
 class IntField(Field):
 	"""映射int的IntField"""
-	def __init__(self, name=None, primary_key=False, default=0, c_type='int'):
-		super().__init__(name, c_type, primary_key, default)
+	def __init__(self, name=None, primary_key=False, default=0, c_type='int', index=False, unique=False):
+		super().__init__(name, c_type, primary_key, default, index, unique)
 
 class FloatField(Field):
 	'''映射float值的FloatField'''
-	def __init__(self, name=None, primary_key=False, default=0.0, c_type='real'):
-		super().__init__(name, c_type, primary_key, default)
+	def __init__(self, name=None, primary_key=False, default=0.0, c_type='real', index=False, unique=False):
+		super().__init__(name, c_type, primary_key, default, index, unique)
 
 class BooleanField(Field):
 	"""映射bool值的BooleanField"""
-	def __init__(self, name=None, primary_key=False, default=False, c_type='boolean'):
-		super().__init__(name, c_type, primary_key, default)
+	def __init__(self, name=None, primary_key=False, default=False, c_type='boolean', index=False, unique=False):
+		super().__init__(name, c_type, primary_key, default, index, unique)
 
 class TextField(Field):
-	"""映射文本值的TextField"""
-	def __init__(self, name=None, primary_key=False, default=None, c_type='text'):
+	"""映射文本值的TextField
+	lazy=True时findAll默认不查询该列，需要时用load_deferred()再加载"""
+	def __init__(self, name=None, primary_key=False, default=None, c_type='text', lazy=False):
 		super().__init__(name,c_type,primary_key,default)
+		self.lazy = lazy
 		
 
+'''紧凑行：元类为每个Model生成一个 Model.Row 类，用__slots__按固定的列顺序保存值
+   没有每行一个dict的开销，可直接由元组游标的一行构造：Blog.Row(*row)
+   保留getValue/getValueOrDefault，用_asdict()转成dict(json序列化时使用)'''
+class CompactRow(object):
+	__slots__ = ()
+
+	def __init__(self, *values, **kw):
+		for name, value in zip(self.__slots__, values):
+			object.__setattr__(self, name, value)
+		for name, value in kw.items():
+			object.__setattr__(self, name, value)
+
+	def __getitem__(self, key):
+		try:
+			return getattr(self, key)
+		except AttributeError:
+			raise KeyError(key)
+
+	def __contains__(self, key):
+		return hasattr(self, key)
+
+	def keys(self):
+		return [k for k in self.__slots__ if hasattr(self, k)]
+
+	def _asdict(self):
+		return dict((k, getattr(self, k)) for k in self.keys())
+
+	def __repr__(self):
+		return '%s(%s)' % (self.__class__.__name__, self._asdict())
+
+	def getValue(self, key):
+		return getattr(self, key)
+
+	def getValueOrDefault(self, key):
+		value = getattr(self, key, None)
+		if value is None:
+			field = self.__model__.__mappings__[key]
+			if field.default is not None:
+				value = field.default() if callable(field.default) else field.default
+				setattr(self, key, value)
+		return value
+
+	#转回可保存/更新的Model实例
+	def to_model(self):
+		return self.__model__(**self._asdict())
+
+
 '''-------------------------------分割线-------------------------------------'''
 class ModelMetaclass(type):
 	''' 元类可以这样子定义:class UpperAttrMetaclass(type),type是Python的内建元类
@@ -171,18 +732,46 @@ class ModelMetaclass(type):
 		escaped_fields = list(map(lambda f: '`%s`' % f, fields))
 		#保存属性和列的映射关系：attrs.__mappings__ = {key字段名1:value字段实例1, key字段名2:value字段实例2....}
 		attrs['__mappings__'] = mappings
+		'''二级索引：[(索引名, (列...), 是否唯一)]
+		   来自字段的index=True/unique=True，以及实现类声明的组合索引
+		   __indexes__ = [('blog_id', 'created_at')]，__unique_indexes__ = [...]'''
+		indexes = []
+		for k, v in mappings.items():
+			if not v.primary_key and (v.index or v.unique):
+				indexes.append(('%s_%s_%s' % ('uq' if v.unique else 'idx', tableName, k), (k,), bool(v.unique)))
+		for unique, key in ((False, '__indexes__'), (True, '__unique_indexes__')):
+			for cols in attrs.get(key, ()):
+				cols = tuple(cols)
+				for c in cols:
+					if c not in mappings:
+						raise RuntimeError('Index column not found: %s' % c)
+				indexes.append(('%s_%s_%s' % ('uq' if unique else 'idx', tableName, '_'.join(cols)), cols, unique))
+		attrs['__index_list__'] = indexes
 		attrs['__table__'] = tableName
 		#主键属性名
 		attrs['__primary_key__'] = primaryKey
+		_primary_keys[tableName] = primaryKey
 		#除主键外的属性名
 		attrs['__fields__'] = fields
 		#构造默认的sql初始语句
 		attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ','.join(escaped_fields), tableName)
-		attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ','.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
+		#延迟加载的列(lazy的TextField)，以及不含这些列的select语句，findAll默认使用
+		lazy_fields = [f for f in fields if getattr(mappings[f], 'lazy', False)]
+		attrs['__lazy_fields__'] = lazy_fields
+		attrs['__list_columns__'] = [f for f in [primaryKey] + fields if f not in lazy_fields]
+		attrs['__select_list__'] = 'select %s from `%s`' % (','.join(['`%s`' % f for f in attrs['__list_columns__']]), tableName)
+		#直接执行的insert/update/delete语句在建类时就编译成驱动的占位符
+		attrs['__insert__'] = _compile('insert into `%s` (%s, `%s`) values (%s)' % (tableName, ','.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1)))
+		#多行insert的语句头和每一行的占位符：insert into tablename (...) values (?,?..),(?,?..)
+		attrs['__insert_head__'] = 'insert into `%s` (%s, `%s`) values ' % (tableName, ','.join(escaped_fields), primaryKey)
+		attrs['__insert_row__'] = '(%s)' % create_args_string(len(escaped_fields) + 1)
 		#update tablename set 非主键field的实例=? where primarykey = ?
-		attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ','.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
-		attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
-		return type.__new__(cls, name, bases, attrs)
+		attrs['__update__'] = _compile('update `%s` set %s where `%s`=?' % (tableName, ','.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey))
+		attrs['__delete__'] = _compile('delete from `%s` where `%s`=?' % (tableName, primaryKey))
+		model = type.__new__(cls, name, bases, attrs)
+		#紧凑行类，slots的顺序与__select__的列顺序一致
+		model.Row = type('%sRow' % name, (CompactRow,), dict(__slots__=tuple([primaryKey] + fields), __model__=model))
+		return model
 
 
 '''Model从dict继承，所以具备有dict的功能，因此可以像引用普通字段那样子写:user['id'] / user.id'''
@@ -223,49 +812,147 @@ class Model(dict, metaclass=ModelMetaclass):
 				setattr(self, key, value)
 		return value
 
+	'''列投影：columns=只查询这些列，defer=不查询这些列；主键总会被查询
+	   都不指定时，full=True返回完整的__select__，否则返回跳过lazy列的__select_list__'''
+	@classmethod
+	def _select_sql(cls, columns=None, defer=None, full=False):
+		if columns is None and defer is None:
+			return cls.__select__ if full else cls.__select_list__
+		return 'select %s from `%s`' % (','.join(['`%s`' % f for f in cls._select_columns(columns, defer)]), cls.__table__)
+
+	#_select_sql查询的列名(按select中的顺序)
+	@classmethod
+	def _select_columns(cls, columns=None, defer=None, full=False):
+		names = [cls.__primary_key__] + cls.__fields__
+		if columns is None and defer is None:
+			return names if full else cls.__list_columns__
+		if columns is not None:
+			names = [f for f in names if f in columns or f == cls.__primary_key__]
+		if defer is not None:
+			names = [f for f in names if f not in defer or f == cls.__primary_key__]
+		return names
+
 	@classmethod
-	async def find(cls,pk):
+	async def find(cls, pk, columns=None, defer=None):
 		#定义找主键的类方法，以类的形式返回
-		rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+		#__batch_find__ = True 的实现类，同一事件循环tick内并发的find()合并成一条in查询(事务内或刚写入后不合并)
+		if getattr(cls, '__batch_find__', False) and _tx_conn.get() is None and not _recent_write() and columns is None and defer is None:
+			return await FindLoader.get(cls).load(pk)
+		#单条记录默认查询所有列(包括lazy列)
+		sql = _cache_sql(('find', cls, _freeze(columns), _freeze(defer)), lambda: '%s where `%s`=?' % (cls._select_sql(columns, defer, full=True), cls.__primary_key__))
+		rs = await _cached_select(cls, sql, [pk], 1)
 		if len(rs) == 0:
 			log('find return none')
 			return None
 		return cls(**rs[0])
 
+	#按主键批量查找：一条 where pk in (...) 查询，按传入顺序返回，找不到的位置为None
+	@classmethod
+	async def find_many(cls, pks):
+		pks = list(pks)
+		if not pks:
+			return []
+		keys = list(dict.fromkeys(pks))
+		sql = _cache_sql(('find_many', cls, len(keys)), lambda: '%s where `%s` in (%s)' % (cls.__select__, cls.__primary_key__, create_args_string(len(keys))))
+		rs = await _cached_select(cls, sql, keys)
+		found = dict((r[cls.__primary_key__], cls(**r)) for r in rs)
+		return [found.get(pk, None) for pk in pks]
+
+	'''findAll的游标(keyset)模式：after=(cursorField的值, 主键值)
+	   以 where (cursorField, 主键) < after 定位，代替limit offset,n，深分页时MySQL无需扫描并丢弃前面的行
+	   cursorField默认created_at，此模式下固定按 cursorField desc, 主键 desc 排序'''
 	@classmethod
 	async def findAll(cls, where=None, args=None, **kw):
-		sql = [cls.__select__]
-		if where:
-			sql.append('where')
-			sql.append(where)
-		if args is None:
-			args = []
+		sql, args = cls._findAll_sql(where, args, kw)
+		#compact=True：用元组游标查询，返回cls.Row紧凑行，省去每行的dict
+		if kw.get('compact', False):
+			names = cls._select_columns(kw.get('columns', None), kw.get('defer', None))
+			rs = await _cached_select(cls, sql, args, as_tuple=True)
+			if len(names) == len(cls.Row.__slots__):
+				return [cls.Row(*r) for r in rs]
+			return [cls.Row(**dict(zip(names, r))) for r in rs]
+		rs = await _cached_select(cls, sql, args)
+		return [cls(**r) for r in rs]
+
+	'''流式遍历：服务端游标(SSDictCursor)每次只取batch行，逐个yield实例，内存占用与表大小无关
+	   async for c in Comment.iter_all('blog_id=?', [id], batch=1000): ...
+	   where/args及orderBy/columns等参数与findAll相同，结果不经过查询缓存'''
+	@classmethod
+	async def iter_all(cls, where=None, args=None, batch=1000, **kw):
+		sql, args = cls._findAll_sql(where, args, kw)
+		async for rs in stream(sql, args, batch):
+			for r in rs:
+				yield cls(**r)
+
+	#构造findAll的sql语句和参数
+	@classmethod
+	def _findAll_sql(cls, where, args, kw):
+		args = list(args) if args else []
+		columns = kw.get('columns', None)
+		defer = kw.get('defer', None)
 		orderBy = kw.get('orderBy', None)
-		if orderBy:
-			sql.append('order by')
-			sql.append(orderBy)
+		after = kw.get('after', None)
+		field = kw.get('cursorField', 'created_at') if 'after' in kw else None
+		if after is not None:
+			args.extend([after[0], after[0], after[1]])
 		limit = kw.get('limit', None)
-		if limit is not None:
-			sql.append('limit')
-			if isinstance(limit, int):
-				sql.append('?')
-				args.append(limit)
-			elif isinstance(limit, tuple) and len(limit) == 2:
-				sql.append('?,?')
-				args.extend(limit)
-			else:
-				raise ValueError('Invalid limit values : %s' % str(limit))
-		rs = await select(' '.join(sql), args)
-		return [cls(**r) for r in rs]
+		if limit is None:
+			limit_shape = 0
+		elif isinstance(limit, int):
+			limit_shape = 1
+			args.append(limit)
+		elif isinstance(limit, tuple) and len(limit) == 2:
+			limit_shape = 2
+			args.extend(limit)
+		else:
+			raise ValueError('Invalid limit values : %s' % str(limit))
+		def build():
+			sql = [cls._select_sql(columns, defer)]
+			w, o = where, orderBy
+			if field is not None:
+				o = '`%s` desc, `%s` desc' % (field, cls.__primary_key__)
+				if after is not None:
+					seek = '(`%s` < ? or (`%s` = ? and `%s` < ?))' % (field, field, cls.__primary_key__)
+					w = '(%s) and %s' % (w, seek) if w else seek
+			if w:
+				sql.append('where')
+				sql.append(w)
+			if o:
+				sql.append('order by')
+				sql.append(o)
+			if limit_shape:
+				sql.append('limit')
+				sql.append('?' if limit_shape == 1 else '?,?')
+			return ' '.join(sql)
+		#同一查询形状只构造、编译一次
+		key = ('findAll', cls, where, orderBy, field, after is not None, limit_shape, _freeze(columns), _freeze(defer))
+		return _cache_sql(key, build), args
 
 	@classmethod
 	async def findNumber(cls, selectField, where=None, args=None):
-		sql = ['select %s as _num_ from `%s`' % (selectField, cls.__table__)]
-		log(sql)
-		if where:
-			sql.append('where')
-			sql.append(where)
-		rs = await select(' '.join(sql), args, 1)
+		ttl = getattr(cls, '__count_ttl__', None)
+		#事务内的计数需要包含未提交的写，不走缓存
+		if ttl and _tx_conn.get() is None:
+			key = (cls.__table__, selectField, where or None, tuple(args or ()))
+			num = _count_cache.get(key)
+			if num is None:
+				version = _count_versions.get(cls.__table__, 0)
+				num = await cls._findNumber(selectField, where, args)
+				if num is not None and version == _count_versions.get(cls.__table__, 0):
+					_count_cache.set(key, num, ttl)
+			return num
+		return await cls._findNumber(selectField, where, args)
+
+	@classmethod
+	async def _findNumber(cls, selectField, where=None, args=None):
+		def build():
+			sql = ['select %s as _num_ from `%s`' % (selectField, cls.__table__)]
+			if where:
+				sql.append('where')
+				sql.append(where)
+			return ' '.join(sql)
+		sql = _cache_sql(('findNumber', cls, selectField, where), build)
+		rs = await _cached_select(cls, sql, args, 1)
 		if len(rs) == 0:
 			log('find return none')
 			return None
@@ -278,20 +965,150 @@ class Model(dict, metaclass=ModelMetaclass):
 		args.append(self.getValueOrDefault(self.__primary_key__))
 		#把设置添加进数据库(表内)
 		rows = await execute(self.__insert__, args)
+		_table_changed(self.__table__, rows)
 		#一条execute语句返回行数为1
 		if rows != 1:
 			logging.warn('failed to insert record: affected rows: %s' % rows)
 
+	#批量保存：每batch_size行拼成一条多行insert语句，一次往返、一次提交
+	#返回每一批的affected rows列表
+	@classmethod
+	async def save_many(cls, instances, batch_size=500):
+		counts = []
+		instances = list(instances)
+		for i in range(0, len(instances), batch_size):
+			batch = instances[i:i + batch_size]
+			args = []
+			for inst in batch:
+				args.extend(map(inst.getValueOrDefault, cls.__fields__))
+				args.append(inst.getValueOrDefault(cls.__primary_key__))
+			sql = _cache_sql(('save_many', cls, len(batch)), lambda: cls.__insert_head__ + ', '.join([cls.__insert_row__] * len(batch)))
+			rows = await execute(sql, args)
+			_table_changed(cls.__table__, rows)
+			if rows != len(batch):
+				logging.warn('failed to insert records: affected rows: %s of %s' % (rows, len(batch)))
+			counts.append(rows)
+		return counts
+
+	'''按条件批量更新/删除，各一条语句，不需要先find
+	   Blog.update_where(dict(user_name='x'), 'user_id=?', [uid])
+	   Blog.update_where({}, 'id=?', [blog_id], incr=dict(comment_count=1))  incr生成`列`=`列`+?，由数据库原子地增减
+	   Comment.delete_where('blog_id=?', [blog_id])
+	   where不能为空，避免误操作整张表；返回affected rows'''
+	@classmethod
+	async def update_where(cls, values, where, args=None, incr=None):
+		if not where:
+			raise ValueError('update_where requires a where clause.')
+		if not values and not incr:
+			raise ValueError('update_where requires values or incr')
+		incr = incr or {}
+		names = list(values.keys())
+		inames = list(incr.keys())
+		for k in names + inames:
+			if k not in cls.__mappings__:
+				raise ValueError('Invalid field: %s' % k)
+		def build():
+			sets = ['`%s`=?' % k for k in names] + ['`%s`=`%s`+?' % (k, k) for k in inames]
+			return 'update `%s` set %s where %s' % (cls.__table__, ','.join(sets), where)
+		sql = _cache_sql(('update_where', cls, tuple(names), tuple(inames), where), build)
+		rows = await execute(sql, [values[k] for k in names] + [incr[k] for k in inames] + list(args or ()))
+		_table_changed(cls.__table__, 0)
+		return rows
+
+	@classmethod
+	async def delete_where(cls, where, args=None):
+		if not where:
+			raise ValueError('delete_where requires a where clause.')
+		sql = _cache_sql(('delete_where', cls, where), lambda: 'delete from `%s` where %s' % (cls.__table__, where))
+		rows = await execute(sql, list(args or ()))
+		_table_changed(cls.__table__, -rows)
+		return rows
+
+	#插入，主键(或唯一索引)已存在时更新其它列：MySQL用on duplicate key update，SQLite用on conflict do update
+	async def upsert(self):
+		cls = self.__class__
+		def build():
+			if backend() == 'sqlite':
+				return '%s on conflict(`%s`) do update set %s' % (cls.__insert_head__ + cls.__insert_row__, cls.__primary_key__, ','.join(['`%s`=excluded.`%s`' % (f, f) for f in cls.__fields__]))
+			return '%s on duplicate key update %s' % (cls.__insert_head__ + cls.__insert_row__, ','.join(['`%s`=values(`%s`)' % (f, f) for f in cls.__fields__]))
+		sql = _cache_sql(('upsert', cls, backend()), build)
+		args = list(map(self.getValueOrDefault, self.__fields__))
+		args.append(self.getValueOrDefault(self.__primary_key__))
+		rows = await execute(sql, args)
+		#MySQL中插入返回1，更新返回2(未改变为0)；SQLite无法区分，计数缓存直接失效
+		_table_changed(self.__table__, 1 if backend() == 'mysql' and rows == 1 else 0)
+		return rows
+
+	#加载未查询的列，默认加载所有缺失的lazy列
+	async def load_deferred(self, *names):
+		names = [f for f in (names or self.__lazy_fields__) if f not in self]
+		if not names:
+			return self
+		rs = await select('select %s from `%s` where `%s`=?' % (','.join(['`%s`' % f for f in names]), self.__table__, self.__primary_key__), [self.getValue(self.__primary_key__)], 1)
+		if len(rs) > 0:
+			dict.update(self, rs[0])
+		return self
+
 	async def delete(self):
 		args = self.getValue(self.__primary_key__)
 		rows = await execute(self.__delete__, args)
+		_table_changed(self.__table__, -rows)
 		if rows != 1:
 			logging.warn('failed to delete by primary key: affected rows: %s' % rows)
 
 	#自定义了update方法，用来更新初始设置的fields,主键不可更改
 	async def update(self):
-		args = list(map(self.getValue,self.__fields__))
+		fields = [f for f in self.__fields__ if f in self]
+		args = list(map(self.getValue,fields))
 		args.append(self.getValue(self.__primary_key__))
-		rows = await execute(self.__update__,args)
+		if len(fields) == len(self.__fields__):
+			sql = self.__update__
+		else:
+			#部分列未加载(投影/延迟加载)时只更新已加载的列，避免把未加载的列写成空值
+			sql = 'update `%s` set %s where `%s`=?' % (self.__table__, ','.join(map(lambda f: '`%s`=?' % f, fields)), self.__primary_key__)
+		rows = await execute(sql,args)
+		_table_changed(self.__table__, 0)
 		if rows != 1:
 			logging.warn('failed to update by primary key: affected rows: %s' % rows)
+
+
+'''FindLoader：把同一tick内对同一个Model的多次find(pk)合并成一次find_many
+   第一次load时安排一个任务，在当前tick其它协程都登记完主键后再统一查询，结果分发给各自的future'''
+class FindLoader(object):
+	_loaders = {}
+
+	@classmethod
+	def get(cls, model):
+		loader = cls._loaders.get(model, None)
+		if loader is None:
+			loader = cls._loaders[model] = cls(model)
+		return loader
+
+	def __init__(self, model):
+		self._model = model
+		self._pending = {}
+
+	def load(self, pk):
+		loop = asyncio.get_event_loop()
+		if not self._pending:
+			#避免继承调用方的事务连接
+			_spawn_detached(self._dispatch())
+		fut = loop.create_future()
+		self._pending.setdefault(pk, []).append(fut)
+		return fut
+
+	async def _dispatch(self):
+		pending, self._pending = self._pending, {}
+		try:
+			rows = await self._model.find_many(list(pending.keys()))
+		except Exception as e:
+			for futs in pending.values():
+				for fut in futs:
+					if not fut.done():
+						fut.set_exception(e)
+			return
+		for row, futs in zip(rows, pending.values()):
+			for fut in futs:
+				if not fut.done():
+					#每个调用方拿到各自的实例，互相修改不受影响
+					fut.set_result(None if row is None else self._model(**row))
@@ -0,0 +1,82 @@
+# -*- coding:utf-8 -*-
+import re, time, hashlib
+
+from aiohttp import web
+from aiohttp.web import middleware
+from email.utils import formatdate, parsedate_to_datetime
+from cache import LRUCache
+from config import configs
+
+'''匿名读者的整页缓存：未登录(request.__user__为None)的GET / 、/blog/{id}、/api/blogs*
+   按path+query缓存渲染好的响应体，命中时不查数据库、不渲染模板
+   响应带强ETag(响应体的sha1)和Last-Modified，If-None-Match/If-Modified-Since匹配时返回304
+   写操作由handlers调用invalidate()使相关页面失效，例如 invalidate('/', '/api/blogs*', '/blog/' + id)'''
+
+_RE_CACHEABLE = re.compile(r'^/$|^/blog/[^/]+$|^/api/blogs')
+
+_PAGE_CACHE = LRUCache(configs['page_cache'].get('size', 512), configs['page_cache'].get('ttl', 60))
+#每次失效加1；渲染期间发生过失效的响应不写入缓存，避免把旧数据重新放回去
+_generation = 0
+
+def invalidate(*paths):
+	'''path精确匹配(忽略query)，以*结尾则按前缀匹配'''
+	global _generation
+	_generation += 1
+	def match(key):
+		for p in paths:
+			if key[0] == p or (p.endswith('*') and key[0].startswith(p[:-1])):
+				return True
+		return False
+	_PAGE_CACHE.delete_if(match)
+
+def clear():
+	global _generation
+	_generation += 1
+	_PAGE_CACHE.clear()
+
+def _not_modified(request, etag, last_modified):
+	inm = request.headers.get('If-None-Match')
+	if inm is not None:
+		return inm.strip() == '*' or etag in [t.strip() for t in inm.split(',')]
+	ims = request.headers.get('If-Modified-Since')
+	if ims:
+		try:
+			return parsedate_to_datetime(ims).timestamp() >= int(last_modified)
+		except (TypeError, ValueError):
+			return False
+	return False
+
+def _respond(request, entry):
+	content_type, body, etag, last_modified = entry
+	headers = {
+		'ETag': etag,
+		'Last-Modified': formatdate(last_modified, usegmt=True),
+		#浏览器每次都用ETag重新验证；登录用户看到的页面不同，按Cookie区分
+		'Cache-Control': 'no-cache',
+		'Vary': 'Cookie'
+	}
+	if _not_modified(request, etag, last_modified):
+		return web.Response(status=304, headers=headers)
+	headers['Content-Type'] = content_type
+	return web.Response(body=body, headers=headers)
+
+@middleware
+async def page_cache(request, handler):
+	if request.method != 'GET' or request.__user__ is not None or not _RE_CACHEABLE.match(request.path):
+		return await handler(request)
+	key = (request.path, request.query_string)
+	entry = _PAGE_CACHE.get(key)
+	if entry is not None:
+		return _respond(request, entry)
+	generation = _generation
+	#告诉response_factory这个响应要缓存，不要分块发送
+	request.__page_cache__ = True
+	r = await handler(request)
+	#只缓存完整的200响应(不缓存重定向、错误和流式响应)
+	if type(r) is not web.Response or r.status != 200 or r.body is None or not isinstance(r.body, bytes):
+		return r
+	body = r.body
+	entry = (r.headers.get('Content-Type', 'application/octet-stream'), body, '"%s"' % hashlib.sha1(body).hexdigest(), time.time())
+	if generation == _generation:
+		_PAGE_CACHE.set(key, entry)
+	return _respond(request, entry)
@@ -0,0 +1,68 @@
+# -*- coding:utf-8 -*-
+import asyncio, logging, sys
+
+import ormstructure
+from Models import Blog, Comment
+
+'''重算Blog上维护的评论统计(comment_count、last_commented_at)
+   平时由创建/删除评论的接口维护，这里用于上线新列后的回填，或修复手工改数据造成的偏差
+
+   按主键顺序每次取batch篇博客，用一条带相关子查询的update重算这批博客(MySQL和SQLite都支持)，
+   计数在数据库内计算，不会把并发新增的评论覆盖成旧值；每批只使缓存失效一次
+
+   backfill_blog_html：为html_content缺失或过期(content_hash不一致)的博客渲染并保存html，
+   get_blog遇到这类博客只在内存中渲染，不在GET中写数据库
+
+   命令行：python repair.py [comments|html] [batch]'''
+
+async def repair_comment_stats(batch=500):
+	'''返回处理的博客数'''
+	total = 0
+	last_id = ''
+	while True:
+		blogs = await Blog.findAll('`id`>?', [last_id], orderBy='`id`', limit=batch, columns=['id'])
+		if not blogs:
+			break
+		last_id = blogs[-1].id
+		ids = [b.id for b in blogs]
+		await ormstructure.execute('update `{b}` set `comment_count`=(select count(*) from `{c}` where `{c}`.`blog_id`=`{b}`.`id`), '
+			'`last_commented_at`=(select max(`created_at`) from `{c}` where `{c}`.`blog_id`=`{b}`.`id`) where `id` in ({ids})'.format(
+			b=Blog.__table__, c=Comment.__table__, ids=','.join(['?'] * len(ids))), ids)
+		ormstructure._table_changed(Blog.__table__, 0)
+		total += len(ids)
+	logging.info('repaired comment stats of %s blogs' % total)
+	return total
+
+async def backfill_blog_html(batch=100):
+	'''返回重新渲染的博客数'''
+	from handlers import content_hash, render_blog
+	fixed = 0
+	last_id = ''
+	while True:
+		blogs = await Blog.findAll('`id`>?', [last_id], orderBy='`id`', limit=batch, columns=['id', 'content', 'html_content', 'content_hash'])
+		if not blogs:
+			break
+		last_id = blogs[-1].id
+		for b in blogs:
+			if b.content is None or (b.html_content and b.content_hash == content_hash(b.content)):
+				continue
+			render_blog(b)
+			#content作为条件：期间博客被修改过则跳过，不覆盖新的渲染结果
+			await Blog.update_where(dict(html_content=b.html_content, content_hash=b.content_hash), '`id`=? and `content`=?', [b.id, b.content])
+			fixed += 1
+	logging.info('rendered html of %s blogs' % fixed)
+	return fixed
+
+if __name__ == '__main__':
+	import config
+	logging.basicConfig(level=logging.INFO)
+	loop = asyncio.get_event_loop()
+	loop.run_until_complete(ormstructure.create_pool(loop, **config.configs['db']))
+	args = sys.argv[1:]
+	job = repair_comment_stats
+	if args and args[0] in ('comments', 'html'):
+		job = backfill_blog_html if args.pop(0) == 'html' else repair_comment_stats
+	try:
+		print(loop.run_until_complete(job(int(args[0])) if args else job()))
+	finally:
+		loop.run_until_complete(ormstructure.close_pool())
@@ -0,0 +1,97 @@
+# -*- coding:utf-8 -*-
+import asyncio, logging, sys
+
+import ormstructure
+
+'''由Model的字段定义(元类生成的__mappings__、__index_list__)生成数据库结构
+
+   create_table_sql(Model)   完整的create table + create index语句
+   await schema_diff(Model)  对比information_schema，只返回缺失的表、列和索引的DDL
+   await create_all(*models) 执行schema_diff的结果
+
+   命令行：python schema.py          输出所有Model的完整DDL
+           python schema.py --diff   连接数据库，输出需要执行的DDL
+           python schema.py --apply  连接数据库，执行需要的DDL'''
+
+def column_sql(model, name):
+	field = model.__mappings__[name]
+	#没有默认值的列允许为空，例如后来添加的列
+	null = 'not null' if field.primary_key or field.default is not None else 'null'
+	#数值/布尔的常量默认值写进DDL，给已有的表add column时旧行才有值(SQLite的not null列也必须有默认值)
+	default = field.default
+	if isinstance(default, (bool, int, float)):
+		return '`%s` %s %s default %s' % (name, field.column_type, null, repr(int(default) if isinstance(default, bool) else default))
+	return '`%s` %s %s' % (name, field.column_type, null)
+
+def index_sql(model, index):
+	name, cols, unique = index
+	return 'create %sindex `%s` on `%s` (%s)' % ('unique ' if unique else '', name, model.__table__, ', '.join(['`%s`' % c for c in cols]))
+
+def create_table_sql(model, if_not_exists=True):
+	L = [column_sql(model, f) for f in [model.__primary_key__] + model.__fields__]
+	L.append('primary key (`%s`)' % model.__primary_key__)
+	#SQLite不支持engine/charset选项
+	options = '' if ormstructure.backend() == 'sqlite' else ' engine=innodb default charset=utf8'
+	sql = ['create table %s`%s` (\n\t%s\n)%s' % ('if not exists ' if if_not_exists else '', model.__table__, ',\n\t'.join(L), options)]
+	sql.extend([index_sql(model, index) for index in model.__index_list__])
+	return sql
+
+async def schema_diff(model):
+	if ormstructure.backend() == 'sqlite':
+		return await _sqlite_schema_diff(model)
+	tables = await ormstructure.select('select table_name as name from information_schema.tables where table_schema=database() and table_name=?', [model.__table__])
+	if not tables:
+		return create_table_sql(model)
+	rs = await ormstructure.select('select column_name as name from information_schema.columns where table_schema=database() and table_name=?', [model.__table__])
+	columns = set([r['name'] for r in rs])
+	rs = await ormstructure.select('select distinct index_name as name from information_schema.statistics where table_schema=database() and table_name=?', [model.__table__])
+	indexes = set([r['name'] for r in rs])
+	return _missing_ddl(model, columns, indexes)
+
+def _missing_ddl(model, columns, indexes):
+	sql = []
+	for f in [model.__primary_key__] + model.__fields__:
+		if f not in columns:
+			sql.append('alter table `%s` add column %s' % (model.__table__, column_sql(model, f)))
+	for index in model.__index_list__:
+		if index[0] not in indexes:
+			sql.append(index_sql(model, index))
+	return sql
+
+#SQLite没有information_schema，用sqlite_master和pragma table_info
+async def _sqlite_schema_diff(model):
+	tables = await ormstructure.select("select name from sqlite_master where type='table' and name=?", [model.__table__])
+	if not tables:
+		return create_table_sql(model)
+	rs = await ormstructure.select('pragma table_info(`%s`)' % model.__table__, [])
+	columns = set([r['name'] for r in rs])
+	rs = await ormstructure.select("select name from sqlite_master where type='index' and tbl_name=?", [model.__table__])
+	indexes = set([r['name'] for r in rs])
+	return _missing_ddl(model, columns, indexes)
+
+async def create_all(*models, dry_run=False):
+	applied = []
+	for model in models:
+		for sql in await schema_diff(model):
+			logging.info('DDL: %s' % sql)
+			if not dry_run:
+				await ormstructure.execute(sql, ())
+			applied.append(sql)
+	return applied
+
+if __name__ == '__main__':
+	from Models import User, Blog, Comment
+	models = (User, Blog, Comment)
+	if len(sys.argv) < 2:
+		for model in models:
+			print(';\n'.join(create_table_sql(model)) + ';\n')
+		sys.exit(0)
+	import config
+	loop = asyncio.get_event_loop()
+	loop.run_until_complete(ormstructure.create_pool(loop, **config.configs['db']))
+	try:
+		applied = loop.run_until_complete(create_all(*models, dry_run=(sys.argv[1] != '--apply')))
+	finally:
+		loop.run_until_complete(ormstructure.close_pool())
+	for sql in applied:
+		print(sql + ';')
@@ -0,0 +1,167 @@
+# -*- coding:utf-8 -*-
+import asyncio, logging
+
+import aiosqlite
+
+from cache import LRUCache
+
+'''SQLite后端：用aiosqlite实现ormstructure用到的那部分aiomysql接口
+   Pool(with (await pool) as conn / size / freesize)、Connection(cursor/begin/commit/rollback)
+   以及Cursor、DictCursor、SSDictCursor三种游标
+   用于没有MySQL服务器时的本地压测、性能分析和快速测试，configs['db']中设置
+   'backend':'sqlite', 'sqlite_path':':memory:' (或数据库文件路径)
+
+   ormstructure编译出的是%s占位符、%%转义的语句(和pymysql一样会做%格式化)，
+   这里再转换成SQLite的?占位符'''
+
+_qmark_cache = LRUCache(maxsize=4096, ttl=None)
+
+def _to_qmark(sql):
+	q = _qmark_cache.get(sql, None)
+	if q is None:
+		L = []
+		i = 0
+		while i < len(sql):
+			ch = sql[i]
+			if ch == '%' and i + 1 < len(sql):
+				nxt = sql[i + 1]
+				if nxt == 's':
+					L.append('?')
+					i += 2
+					continue
+				if nxt == '%':
+					L.append('%')
+					i += 2
+					continue
+			L.append(ch)
+			i += 1
+		q = ''.join(L)
+		_qmark_cache.set(sql, q)
+	return q
+
+#pymysql允许单个参数不放在列表里
+def _params(args):
+	if args is None:
+		return ()
+	if isinstance(args, (list, tuple, dict)):
+		return args
+	return (args,)
+
+class Cursor(object):
+	"""返回元组行的游标"""
+	_as_dict = False
+
+	def __init__(self, conn):
+		self._conn = conn
+		self._cur = None
+		self.rowcount = -1
+		self.description = None
+
+	async def execute(self, sql, args=None):
+		self._cur = await self._conn._db.execute(_to_qmark(sql), _params(args))
+		self.rowcount = self._cur.rowcount
+		self.description = self._cur.description
+		return self.rowcount
+
+	def _rows(self, rs):
+		if not self._as_dict:
+			return [tuple(r) for r in rs]
+		names = [d[0] for d in self.description or ()]
+		return [dict(zip(names, r)) for r in rs]
+
+	async def fetchall(self):
+		return self._rows(await self._cur.fetchall())
+
+	async def fetchmany(self, size):
+		return self._rows(await self._cur.fetchmany(size))
+
+	async def close(self):
+		if self._cur is not None:
+			await self._cur.close()
+			self._cur = None
+
+class DictCursor(Cursor):
+	"""返回dict行的游标"""
+	_as_dict = True
+
+class SSDictCursor(DictCursor):
+	"""SQLite的游标本来就是逐步取行的，与DictCursor相同"""
+	pass
+
+class Connection(object):
+	def __init__(self, db):
+		self._db = db
+
+	async def cursor(self, cursor_class=None):
+		return (cursor_class or Cursor)(self)
+
+	async def begin(self):
+		await self._db.execute('begin')
+
+	async def commit(self):
+		if self._db.in_transaction:
+			await self._db.commit()
+
+	async def rollback(self):
+		if self._db.in_transaction:
+			await self._db.rollback()
+
+	#终止正在执行的语句(语句超时时使用)
+	async def interrupt(self):
+		await self._db.interrupt()
+
+class _PoolConnection(object):
+	"""with (await pool) as conn: 退出with时把连接还给pool"""
+	def __init__(self, pool, conn):
+		self._pool = pool
+		self._conn = conn
+
+	def __enter__(self):
+		return self._conn
+
+	def __exit__(self, *exc):
+		self._pool._free.put_nowait(self._conn)
+
+class Pool(object):
+	def __init__(self, path, maxsize):
+		self.path = path
+		self.maxsize = maxsize
+		self._conns = []
+		self._free = asyncio.Queue()
+
+	async def _fill(self):
+		for n in range(self.maxsize):
+			#isolation_level=None：自动提交，事务由begin/commit显式控制
+			db = await aiosqlite.connect(self.path, isolation_level=None)
+			conn = Connection(db)
+			self._conns.append(conn)
+			self._free.put_nowait(conn)
+
+	@property
+	def size(self):
+		return len(self._conns)
+
+	@property
+	def freesize(self):
+		return self._free.qsize()
+
+	async def _acquire(self):
+		conn = await self._free.get()
+		return _PoolConnection(self, conn)
+
+	def __await__(self):
+		return self._acquire().__await__()
+
+	async def close(self):
+		for conn in self._conns:
+			await conn._db.close()
+		self._conns = []
+
+async def create_pool(path=':memory:', maxsize=5):
+	#每个:memory:连接都是独立的数据库，内存模式只能用一个连接
+	if path == ':memory:':
+		maxsize = 1
+	logging.info('create sqlite connection pool: %s' % path)
+	pool = Pool(path, maxsize)
+	await pool._fill()
+	return pool
@@ -6,9 +6,11 @@ from Models import User
 
 async def test(loop):
 	await ormstructure.create_pool(loop,user='xxxx',password='xxxxxxx',db='awsome')
-	for name in ['jack','bill','jenny','french']:
-		u = User(name=name, email=name+'@example.com', passwd=name+'123456', image='about:'+name)
-		await u.save()
+	try:
+		users = [User(name=name, email=name+'@example.com', passwd=name+'123456', image='about:'+name) for name in ['jack','bill','jenny','french']]
+		await User.save_many(users)
+	finally:
+		await ormstructure.close_pool()
 	
 if __name__ == '__main__':
 	loop = asyncio.get_event_loop()
@@ -1,7 +1,7 @@
 # -*- coding:utf-8 -*-
-import functools, asyncio, inspect, logging, os, time
+import functools, asyncio, inspect, logging, os, time, mimetypes, compress
 from aiohttp import web
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 from ApiError import APIError
 from urllib import parse
 
@@ -198,10 +198,33 @@ def add_routes(app, module_name):
 				add_route(app, fn)
 
 #添加静态文件，如image,css,javascript等
+#静态文件的预压缩版本(由compress.py生成)，按优先顺序
+_PRECOMPRESSED = (('br', '.br'), ('gzip', '.gz'))
+
 def add_static(app):
 	#__file__返回当前模块的路径(如果sys.path包含当前模块则返回相对路径，否则绝对路径)
-	path = os.path.join(os.path.dirname(os.path.abspath(__file__)),'static')
-	app.router.add_static('/static/', path)
+	path = os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)),'static'))
+	async def static(request):
+		filename = os.path.realpath(os.path.join(path, request.match_info['filename']))
+		#不允许访问static目录以外的文件
+		if not filename.startswith(path + os.sep) or not os.path.isfile(filename):
+			raise web.HTTPNotFound()
+		headers = {'Content-Type': mimetypes.guess_type(filename)[0] or 'application/octet-stream'}
+		#dist/下是带内容哈希的文件(assets.py生成)，内容不会改变，浏览器缓存一年且不再验证
+		if request.match_info['filename'].startswith('dist/'):
+			headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+		#客户端接受且存在预压缩文件时直接返回，不在请求时压缩
+		accepted = compress.accepted_encodings(request)
+		siblings = [(encoding, ext) for encoding, ext in _PRECOMPRESSED if os.path.isfile(filename + ext)]
+		#有预压缩文件时无论返回哪种编码都要带Vary，否则共享缓存可能把未压缩的版本给所有客户端
+		if siblings:
+			headers['Vary'] = 'Accept-Encoding'
+		for encoding, ext in siblings:
+			if encoding in accepted:
+				headers['Content-Encoding'] = encoding
+				return web.FileResponse(filename + ext, headers=headers)
+		return web.FileResponse(filename, headers=headers)
+	app.router.add_route('GET', '/static/{filename:.*}', static)
 	logging.info('add static %s => %s' % ('/static/', path))
 
 def init_jinja2(app, **kw):
@@ -215,12 +238,18 @@ def init_jinja2(app, **kw):
 		#变量的开始、结束标志
 		variable_start_string = kw.get('variable_start_string','{{'),
 		variable_end_string = kw.get('variable_end_string','}}'),
+		#True时每次get_template都检查模板文件是否修改，生产环境关闭
 		auto_reload = kw.get('auto_reload',True)
 		)
 	#获取模板文件夹路径
 	path = kw.get('path', None)
 	if not path:
 		path = os.path.join(os.path.dirname(os.path.abspath(__file__)),'templates')
+	#编译后的模板字节码保存在该目录，多个进程共用，启动时不必重新编译
+	bytecode_cache = kw.get('bytecode_cache', None)
+	if bytecode_cache:
+		os.makedirs(bytecode_cache, exist_ok=True)
+		options['bytecode_cache'] = FileSystemBytecodeCache(bytecode_cache)
 	#Environment类是jinja2的核心类，用来保存配置、全局对象以及模板文件的路径
 	#FileSystemLoader类加载Path路径中的模板文件
 	env = Environment(loader = FileSystemLoader(path), **options)
@@ -230,9 +259,26 @@ def init_jinja2(app, **kw):
 		for name, f in filters.items():
 			#filters是Enviroment类的属性：过滤器字典
 			env.filters[name] = f
+	#全局函数集合，模板中可直接调用
+	functions = kw.get('globals', None)
+	if functions:
+		env.globals.update(functions)
+	#启动时加载所有模板，第一个请求不必等待编译
+	if kw.get('warmup', False):
+		logging.info('warm up %s templates.' % warmup_templates(env))
 	#app是一个dict-like对象
 	app['__template__'] = env
 
+#默认的模板字节码缓存目录
+BYTECODE_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.jinja2_cache')
+
+#编译并缓存所有模板，有bytecode_cache时同时写入字节码；返回模板数
+def warmup_templates(env):
+	names = env.list_templates()
+	for name in names:
+		env.get_template(name)
+	return len(names)
+
 def datetime_filter(t):
 	delta = int(time.time() - t)
 	if delta < 60: